@@ -0,0 +1,249 @@
+#!/usr/bin/python2
+#
+# Replays recorded upstream responses for every chain in services.service
+# through a local stub server, so it needs no network.  For each service
+# it reports resolve latency (p50/p99), time spent in the step regexes,
+# bytes read by the resolver and gc-tracked objects still alive after a resolve
+# (Python 2 has no allocation tracer, so this catches leaks rather than
+# counting every allocation), and compares the latencies against a
+# stored baseline.  Peak RSS of the whole run is printed at the end.
+#
+#    python benchmark.py [-n ITERATIONS] [-c SERVICE] [--json FILE]
+#    python benchmark.py --save-baseline         # after an intended change
+#    python benchmark.py --record [-c SERVICE]   # refresh fixtures from the live sites
+#
+# The exit status is non-zero when a service regressed by more than the
+# threshold (default 25%), stopped producing streams, or read every byte
+# served to it although one of its streamed steps should hang up early.
+
+import BaseHTTPServer, gc, getopt, json, os, resource, socket, SocketServer, sys, threading, time, urllib2
+
+import dispatch, pirateplay
+from connpool import pool
+
+here = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(here, 'fixtures', 'services.json')
+BASELINE = os.path.join(here, 'fixtures', 'baseline.json')
+
+filler = '<div class="filler">Lorem ipsum dolor sit amet, consectetur adipiscing elit.</div>\n'
+
+class no_redirect_handler(urllib2.HTTPRedirectHandler):
+	def http_error_302(self, req, fp, code, msg, headers):
+		return fp
+	http_error_301 = http_error_303 = http_error_307 = http_error_302
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+	wbufsize = -1
+	def respond(self, method):
+		url = 'http://%s%s' % (self.headers.get('Host'), self.path)
+		data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		key = '%s %s' % (method, url)
+		if self.server.recording:
+			self.server.record(key, url, data, self.headers)
+		response = self.server.responses.get(key)
+		if response is None:
+			self.server.missing.add(key)
+			response = {'status': 404, 'body': ''}
+		body = (filler * (response.get('pad', 0) // len(filler)) + response['body'].encode('utf-8')
+			+ filler * (response.get('tail', 0) // len(filler)))
+		with self.server.lock:
+			self.server.served += len(body)
+		self.send_response(response.get('status', 200))
+		for header, value in response.get('headers', {}).items():
+			self.send_header(header, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	def do_GET(self):
+		self.respond('GET')
+	def do_POST(self):
+		self.respond('POST')
+	def log_message(self, format, *args):
+		pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	def __init__(self, responses, recording = False):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+		self.responses = responses
+		self.recording = recording
+		self.missing = set()
+		# Bytes of response bodies sent, or begun to be sent.
+		self.served = 0
+		self.lock = threading.Lock()
+		self.opener = urllib2.build_opener(no_redirect_handler())
+	def handle_error(self, request, client_address):
+		# Streamed steps hang up in the middle of a response on purpose.
+		if not isinstance(sys.exc_info()[1], socket.error):
+			BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+	def record(self, key, url, data, headers):
+		req = urllib2.Request(url, data or None)
+		for header in ('User-Agent', 'Cookie', 'Content-Type'):
+			if header in headers:
+				req.add_header(header, headers[header])
+		try:
+			response = self.opener.open(req)
+		except urllib2.HTTPError as err:
+			response = err
+		except urllib2.URLError:
+			return
+		recorded = {'body': response.read().decode('utf-8', 'replace')}
+		if response.code != 200:
+			recorded['status'] = response.code
+		if 'Location' in response.info():
+			recorded['headers'] = {'Location': response.info()['Location']}
+		self.responses[key] = recorded
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+def hangs_up(steps):
+	# Whether a streamed step stops reading after a number of matches.
+	return any(step.get('stream', True) is not True for step in steps)
+
+def run_chain(name, steps, url):
+	return list(pirateplay.run_steps(name, steps, url, url, pirateplay.initial_vars({'output_file': '-'}), {}))
+
+def measure(name, steps, url, iterations, stub):
+	run_chain(name, steps, url)
+	latencies = []
+	for i in range(iterations):
+		started = time.time()
+		cmds = run_chain(name, steps, url)
+		latencies.append(time.time() - started)
+
+	# Regex time and bytes read come from the resolver's own trace spans,
+	# collected on separate runs so tracing does not skew the latencies
+	# above.  Streamed steps stop reading early, so the bytes read can be
+	# less than the stub served.
+	spans = []
+	served = stub.served
+	pirateplay.set_tracer(spans.append)
+	try:
+		for i in range(iterations):
+			run_chain(name, steps, url)
+	finally:
+		pirateplay.set_tracer(None)
+	regex = sum(span.regex_time for span in spans) / iterations
+	fetched = sum(span.bytes for span in spans) / iterations
+	served = (stub.served - served) / iterations
+
+	gc.collect()
+	gc.disable()
+	retained = len(gc.get_objects())
+	run_chain(name, steps, url)
+	retained = len(gc.get_objects()) - retained
+	gc.enable()
+	return {'p50': percentile(latencies, 0.5) * 1000,
+		'p99': percentile(latencies, 0.99) * 1000,
+		'regex': regex * 1000,
+		'bytes': fetched,
+		'served': served,
+		'retained': retained,
+		'streams': len(cmds)}
+
+def main():
+	opts, values = getopt.getopt(sys.argv[1:], 'n:c:t:', ['iterations=', 'chain=', 'threshold=',
+		'baseline=', 'save-baseline', 'record', 'json='])
+	iterations = 20
+	only = None
+	threshold = 0.25
+	baseline_file = BASELINE
+	save_baseline = False
+	recording = False
+	json_file = None
+	for option, value in opts:
+		if option in ('-n', '--iterations'):
+			iterations = int(value)
+		elif option in ('-c', '--chain'):
+			only = value
+		elif option in ('-t', '--threshold'):
+			threshold = float(value)
+		elif option == '--baseline':
+			baseline_file = value
+		elif option == '--save-baseline':
+			save_baseline = True
+		elif option == '--record':
+			recording = True
+		elif option == '--json':
+			json_file = value
+
+	fixtures = json.load(open(FIXTURES))
+	stub = StubServer(fixtures['responses'], recording)
+	thread = threading.Thread(target = stub.serve_forever)
+	thread.daemon = True
+	thread.start()
+	pool.connect_to = lambda scheme, host: stub.server_address
+	pirateplay.set_cache(None)
+	pirateplay.set_health(None)
+
+	if recording:
+		for name, steps in dispatch.chains:
+			chain = fixtures['chains'].get(name, {})
+			if 'url' in chain and only in (None, name):
+				print 'Recording', name
+				run_chain(name, steps, chain['url'])
+		with open(FIXTURES, 'w') as f:
+			json.dump(fixtures, f, indent = 1, sort_keys = True, separators = (',', ': '))
+			f.write('\n')
+		return 0
+
+	try:
+		baseline = json.load(open(baseline_file))
+	except IOError:
+		baseline = {}
+
+	results = {}
+	failed = []
+	print '%-22s %9s %9s %9s %8s %8s %7s  %s' % ('service', 'p50 ms', 'p99 ms', 'regex ms',
+		'bytes', 'retained', 'streams', 'vs baseline')
+	for name, steps in dispatch.chains:
+		chain = fixtures['chains'].get(name)
+		if only not in (None, name):
+			continue
+		if chain is None or 'skip' in chain:
+			print '%-22s skipped: %s' % (name, chain['skip'] if chain else 'no fixture')
+			continue
+		result = results[name] = measure(name, steps, chain['url'], iterations, stub)
+		change = ''
+		if name in baseline:
+			ratio = result['p50'] / baseline[name]['p50'] - 1
+			change = '%+.0f%%' % (ratio * 100)
+			if ratio > threshold:
+				change += ' REGRESSION'
+				failed.append(name)
+		if result['streams'] == 0:
+			change += ' NO STREAMS'
+			failed.append(name)
+		if hangs_up(steps) and result['bytes'] >= result['served']:
+			change += ' READ WHOLE BODY'
+			failed.append(name)
+		print '%-22s %9.2f %9.2f %9.3f %8d %8d %7d  %s' % (name, result['p50'], result['p99'],
+			result['regex'], result['bytes'], result['retained'], result['streams'], change)
+
+	if stub.missing:
+		print
+		print 'Requests without a recorded response:'
+		for key in sorted(stub.missing):
+			print '  ' + key
+	print
+	print 'Connection pool:', pool.stats()
+	print 'Peak RSS: %d kB' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	if json_file:
+		with open(json_file, 'w') as f:
+			json.dump(results, f, indent = 1, sort_keys = True)
+	if save_baseline:
+		baseline.update(results)
+		with open(baseline_file, 'w') as f:
+			json.dump(baseline, f, indent = 1, sort_keys = True)
+			f.write('\n')
+		print 'Baseline saved to', baseline_file
+		return 0
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
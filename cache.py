@@ -0,0 +1,108 @@
+import hashlib, os, threading, time
+from collections import OrderedDict
+
+# Response caches used by pirateplay.fetch.  Entries are keyed on the
+# final URL, POST body and request headers, expire after a per-service
+# TTL and are evicted least-recently-used once the cache is full.
+
+def cache_key(url, data, headers):
+	return (url, data, tuple(sorted(headers.items())))
+
+class ResponseCache(object):
+	def __init__(self, size = 256, ttl = 300, ttls = None):
+		self.size = size
+		self.ttl = ttl
+		self.ttls = ttls or {}
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+	def ttl_for(self, service_name):
+		return self.ttls.get(service_name, self.ttl)
+	def get(self, key):
+		with self._lock:
+			content = self._get(key, time.time())
+			if content is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+			return content
+	def put(self, key, content, service_name = None):
+		ttl = self.ttl_for(service_name)
+		if ttl <= 0:
+			return
+		with self._lock:
+			self._put(key, content, time.time() + ttl)
+
+class MemoryCache(ResponseCache):
+	def __init__(self, *args, **kwargs):
+		ResponseCache.__init__(self, *args, **kwargs)
+		self._entries = OrderedDict()
+	def __len__(self):
+		return len(self._entries)
+	def _get(self, key, now):
+		try:
+			expires, content = self._entries.pop(key)
+		except KeyError:
+			return None
+		if expires < now:
+			return None
+		self._entries[key] = (expires, content)
+		return content
+	def _put(self, key, content, expires):
+		self._entries.pop(key, None)
+		self._entries[key] = (expires, content)
+		while len(self._entries) > self.size:
+			self._entries.popitem(last = False)
+
+class DiskCache(ResponseCache):
+	# Entries are files named by key hash.  Which files there are, least
+	# recently used first, is kept in memory so that a put does not have to
+	# list the directory; it is read from the directory (by modification
+	# time) once, at start.
+	def __init__(self, path, *args, **kwargs):
+		ResponseCache.__init__(self, *args, **kwargs)
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		names = [name for name in os.listdir(path) if not name.endswith('.tmp')]
+		names.sort(key = lambda name: os.path.getmtime(os.path.join(path, name)))
+		self._names = OrderedDict((name, None) for name in names)
+	def __len__(self):
+		return len(self._names)
+	def _name(self, key):
+		return hashlib.sha1(repr(key)).hexdigest()
+	def _remove(self, name):
+		self._names.pop(name, None)
+		try:
+			os.unlink(os.path.join(self.path, name))
+		except OSError:
+			pass
+	def _get(self, key, now):
+		name = self._name(key)
+		filename = os.path.join(self.path, name)
+		try:
+			with open(filename, 'rb') as f:
+				expires = float(f.readline())
+				content = f.read()
+		except (IOError, ValueError):
+			self._names.pop(name, None)
+			return None
+		if expires < now:
+			self._remove(name)
+			return None
+		# The modification time doubles as the access time for eviction.
+		os.utime(filename, None)
+		self._names.pop(name, None)
+		self._names[name] = None
+		return content
+	def _put(self, key, content, expires):
+		name = self._name(key)
+		filename = os.path.join(self.path, name)
+		with open(filename + '.tmp', 'wb') as f:
+			f.write('%f\n' % expires)
+			f.write(content)
+		os.rename(filename + '.tmp', filename)
+		self._names.pop(name, None)
+		self._names[name] = None
+		while len(self._names) > self.size:
+			self._remove(next(iter(self._names)))
@@ -0,0 +1,220 @@
+import hashlib, json, mmap, os, urllib2
+
+# The programme catalogue written by parser.py and read by the curses
+# client, replacing the pickled tree.  The file is
+#
+#    PIRATEPLAY-CATALOGUE <version> <index length>\n
+#    <index>
+#    <records>
+#
+# where the index is JSON, {'channels': {channel: {programme: [offset,
+# length, digest]}}}, and each record is the JSON object {episode title:
+# href} of one programme, at offset from the end of the index.  Readers
+# map the file and decode one programme at a time.  A local copy is
+# brought up to date by reading the remote header and index, then only
+# the records whose digest it does not already have, with Range requests;
+# if what comes back does not fit the index the whole file is fetched.
+
+MAGIC = 'PIRATEPLAY-CATALOGUE'
+VERSION = 1
+head_size = 4096
+
+class CatalogueError(Exception):
+	pass
+
+def parse_header(head):
+	line, newline, rest = head.partition('\n')
+	fields = line.split(' ')
+	if not newline or len(fields) != 3 or fields[0] != MAGIC:
+		raise CatalogueError('not a catalogue')
+	if int(fields[1]) != VERSION:
+		raise CatalogueError('unsupported catalogue version %s' % fields[1])
+	start = len(line) + 1
+	return start, start + int(fields[2])
+
+def digest(record):
+	return hashlib.sha1(record).hexdigest()
+
+class Writer(object):
+	# Records are spooled to a side file as programmes are added, and the
+	# catalogue is put together behind its index on close().
+	def __init__(self, path):
+		self.path = path
+		self._records = open(path + '.records', 'w+b')
+		self._offsets = {}
+		self._channels = {}
+		self._size = 0
+
+	def add(self, channel, programme, episodes):
+		record = json.dumps(episodes, sort_keys = True)
+		self._add(channel, programme, record, digest(record))
+
+	def copy(self, channel, programme, source):
+		# Takes a programme over unchanged from another catalogue.
+		self._add(channel, programme, *source.raw(channel, programme))
+
+	def _add(self, channel, programme, record, key):
+		if key not in self._offsets:
+			self._offsets[key] = self._size
+			self._records.write(record)
+			self._size += len(record)
+		self._channels.setdefault(channel, {})[programme] = [self._offsets[key], len(record), key]
+
+	def close(self):
+		index = json.dumps({'channels': self._channels}, sort_keys = True)
+		self._records.seek(0)
+		with open(self.path + '.new', 'wb') as f:
+			f.write('%s %d %d\n' % (MAGIC, VERSION, len(index)))
+			f.write(index)
+			while True:
+				chunk = self._records.read(65536)
+				if not chunk:
+					break
+				f.write(chunk)
+		self.discard()
+		os.rename(self.path + '.new', self.path)
+
+	def discard(self):
+		self._records.close()
+		os.unlink(self.path + '.records')
+
+def write(path, data):
+	# data is {channel: {programme: {episode title: href}}}.
+	writer = Writer(path)
+	for channel in sorted(data):
+		for programme in sorted(data[channel]):
+			writer.add(channel, programme, data[channel][programme])
+	writer.close()
+
+class Catalogue(object):
+	def __init__(self, path):
+		self._file = open(path, 'rb')
+		try:
+			self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+			start, self._base = parse_header(self._map[:head_size])
+			self.index = json.loads(self._map[start:self._base])
+		except (ValueError, mmap.error):
+			self._file.close()
+			raise CatalogueError('%s is damaged' % path)
+
+	def channels(self):
+		return sorted(self.index['channels'])
+
+	def programmes(self, channel):
+		return sorted(self.index['channels'][channel])
+
+	def record(self, offset, length):
+		return self._map[self._base + offset:self._base + offset + length]
+
+	def has(self, channel, programme):
+		return programme in self.index['channels'].get(channel, {})
+
+	def raw(self, channel, programme):
+		offset, length, key = self.index['channels'][channel][programme]
+		return self.record(offset, length), key
+
+	def episodes(self, channel, programme):
+		return json.loads(self.raw(channel, programme)[0])
+
+	def records(self):
+		# {digest: (offset, length)} of every record in the file.
+		found = {}
+		for programmes in self.index['channels'].values():
+			for offset, length, key in programmes.values():
+				found[key] = (offset, length)
+		return found
+
+	def close(self):
+		self._map.close()
+		self._file.close()
+
+def fetch_range(url, start, end):
+	# (data, whole) where whole is True if the server sent the entire file.
+	req = urllib2.Request(url, headers = {'Range': 'bytes=%d-%d' % (start, end)})
+	response = urllib2.urlopen(req)
+	try:
+		return response.read(), response.code != 206
+	finally:
+		response.close()
+
+def fetch_full(url, path):
+	response = urllib2.urlopen(url)
+	with open(path + '.new', 'wb') as f:
+		f.write(response.read())
+	response.close()
+	os.rename(path + '.new', path)
+
+def refetch(url, path, local):
+	# The file changed under us (or a record came back wrong): start over
+	# from scratch.
+	if local is not None:
+		local.close()
+	fetch_full(url, path)
+	return Catalogue(path)
+
+def spans(wanted):
+	# Merges (offset, length) pairs that sit next to each other.
+	merged = []
+	for offset, length in sorted(wanted):
+		if merged and merged[-1][0] + merged[-1][1] == offset:
+			merged[-1][1] += length
+		else:
+			merged.append([offset, length])
+	return merged
+
+def update(url, path):
+	# Brings the catalogue at path up to date with the one at url and
+	# returns it opened.
+	try:
+		local = Catalogue(path)
+	except (IOError, CatalogueError):
+		local = None
+	head, whole = fetch_range(url, 0, head_size - 1)
+	if whole:
+		if local is not None:
+			local.close()
+		with open(path + '.new', 'wb') as f:
+			f.write(head)
+		os.rename(path + '.new', path)
+		return Catalogue(path)
+	start, base = parse_header(head)
+	if base > len(head):
+		head += fetch_range(url, len(head), base - 1)[0]
+		if len(head) < base:
+			return refetch(url, path, local)
+	index_data = head[start:base]
+	index = json.loads(index_data)
+	if local is not None and local.index == index:
+		return local
+
+	have = local.records() if local is not None else {}
+	wanted = {}
+	for programmes in index['channels'].values():
+		for offset, length, key in programmes.values():
+			wanted[key] = (offset, length)
+	size = max([offset + length for offset, length in wanted.values()] or [0])
+	data = bytearray(size)
+	missing = []
+	for key, (offset, length) in wanted.items():
+		if key in have:
+			data[offset:offset + length] = local.record(*have[key])
+		elif base + offset + length <= len(head):
+			data[offset:offset + length] = head[base + offset:base + offset + length]
+		else:
+			missing.append((offset, length))
+	for offset, length in spans(missing):
+		part, whole = fetch_range(url, base + offset, base + offset + length - 1)
+		if whole or len(part) != length:
+			return refetch(url, path, local)
+		data[offset:offset + length] = part
+	for key, (offset, length) in wanted.items():
+		if digest(str(data[offset:offset + length])) != key:
+			return refetch(url, path, local)
+
+	if local is not None:
+		local.close()
+	with open(path + '.new', 'wb') as f:
+		f.write(head[:base])
+		f.write(data)
+	os.rename(path + '.new', path)
+	return Catalogue(path)
@@ -1,9 +1,15 @@
 # coding=utf8
 
-import curses, curses.textpad, pickle, urllib2, shlex, subprocess, sys, thread, traceback
+import curses, curses.textpad, os, urllib2, sys, threading, traceback
+from collections import deque
 
 #sys.path.append('/home/chucky/utveckling/pirateplay')
-from pirateplay import generate_getcmd, remove_duplicates
+from pirateplay import generate_streams, unique
+from media import Supervisor
+import catalogue
+
+catalogue_url = 'http://pirateplay.se/catalogue.dat'
+catalogue_path = os.path.expanduser('~/.pirateplay-catalogue')
 
 class Menu():
 	def __init__(self, data, scr, y, x):
@@ -82,21 +88,115 @@ class Menu():
 	def set_data(self, data):
 		self.__data = data
 		self.__curr_list = data
+	def extend_data(self, data):
+		# New items added after the existing ones; keeps the position.
+		self.__data = data
+		self.update_list()
+		self.__curr_selected = min(self.__curr_selected, len(self.__curr_list)-1)
+		self.draw()
 	def get_current(self, key):
 		return self.__curr_list[self.__curr_selected][key]
+	def get_nearby(self, key, radius):
+		# The selected item's key first, then its neighbours'.
+		items = []
+		for i in [0] + [d * sign for d in range(1, radius + 1) for sign in (1, -1)]:
+			if 0 <= self.__curr_selected + i < len(self.__curr_list):
+				items.append(self.__curr_list[self.__curr_selected + i].get(key))
+		return items
 
-def dict2list(dict):
-		new_list = []
-		try:
-			for key, value in sorted(dict.items(), key=lambda item: item[0]):
-				next_dict = dict2list(value)
-				if next_dict != False:
-					new_list.append({'title' : key, 'list' : dict2list(value), 'data' : None})
+class StreamCache():
+	# Resolves episodes on background threads and keeps their streams for
+	# the session.  The episode the user opened goes first; otherwise the
+	# most recently highlighted ones, of which only the last few are kept
+	# waiting.
+	def __init__(self, workers = 2, prefetch = 6, deadline = 30):
+		self.__entries = {}
+		self.__wanted = deque()
+		self.__prefetch = deque(maxlen = prefetch)
+		self.__deadline = deadline
+		self.__cond = threading.Condition()
+		for i in range(workers):
+			worker = threading.Thread(target = self.__work)
+			worker.daemon = True
+			worker.start()
+	def want(self, url, now = False):
+		with self.__cond:
+			if url in self.__entries:
+				return
+			if url in self.__prefetch:
+				self.__prefetch.remove(url)
+			if now:
+				self.__wanted.appendleft(url)
+			else:
+				self.__prefetch.append(url)
+			self.__cond.notify()
+	def get(self, url):
+		# (streams so far, whether the resolve is over, why it failed if it did)
+		with self.__cond:
+			entry = self.__entries.get(url)
+			if entry is None:
+				return [], False, None
+			return list(entry['streams']), entry['done'], entry['error']
+	def __take(self):
+		with self.__cond:
+			while True:
+				queue = self.__wanted or self.__prefetch
+				if queue:
+					url = queue.pop() if queue is self.__prefetch else queue.popleft()
+					if url not in self.__entries:
+						entry = self.__entries[url] = {'streams': [], 'done': False, 'error': None}
+						return url, entry
 				else:
-					new_list.append({'title' : key, 'data' : value})
-			return new_list
-		except AttributeError:
-			return False
+					self.__cond.wait()
+	def __work(self):
+		while True:
+			url, entry = self.__take()
+			try:
+				for stream in unique(generate_streams(url.encode('utf-8'), deadline = self.__deadline, output_file = '-')):
+					with self.__cond:
+						entry['streams'].append(stream)
+			except Exception as err:
+				with self.__cond:
+					entry['error'] = str(err).decode('utf-8', 'replace')
+			with self.__cond:
+				entry['done'] = True
+
+def stream_list(streams, done, error = None):
+	items = []
+	for stream in streams:
+		items.append(
+					{
+						'title' : stream.meta,
+						'data' 	: None,
+						'list' 	: [
+								{'title' : 'play', 'data' : stream.cmd},
+								{'title' : 'download', 'data' : stream.cmd}]})
+	if not done:
+		items.append({'title' : u'Söker...', 'data' : None})
+	elif error is not None:
+		items.append({'title' : u'Fel: %s' % error, 'data' : None})
+	elif not items:
+		items.append({'title' : u'Inga strömmar hittades', 'data' : None})
+	return items
+
+class Programme(dict):
+	# A programme's episodes are read from the catalogue when its menu is
+	# first opened.
+	def __init__(self, source, channel, title):
+		dict.__init__(self, title = title, data = None)
+		self.__catalogue = source
+		self.__channel = channel
+	def __missing__(self, key):
+		if key != 'list':
+			raise KeyError(key)
+		episodes = self.__catalogue.episodes(self.__channel, self['title'])
+		self['list'] = [{'title' : title, 'data' : episodes[title]} for title in sorted(episodes)]
+		return self['list']
+
+def catalogue_list(source):
+	return [{'title' : channel, 'data' : None,
+			'list' : [Programme(source, channel, title) for title in source.programmes(channel)]}
+		for channel in source.channels()]
 
 def main():
 	def print_help(s):
@@ -104,19 +204,11 @@ def main():
 		help_win.addstr(s)
 		help_win.noutrefresh()
 		curses.doupdate()
-	def download(filename, cmd):
-		child = subprocess.Popen(shlex.split(cmd + ' -o ' + filename), shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		complete = False
-		buffered = ''
-		start = False
-		while True:
-			out = child.stderr.read(7)
-			if out == '' and child.poll() != None:
-				print_help('Nedladdning klar!')
-				break
-			elif len(out) > 1:
-				if out[0] == '(' and out[1] != 'c':
-					print_help('Laddar ner - ' + out[1:out.find(')')])
+	def show_jobs():
+		jobs_win.clear()
+		for i, job in enumerate(supervisor.jobs[-5:]):
+			jobs_win.addstr(i, 0, ('%d %s' % (i + 1, job.status()))[:stdscr.getmaxyx()[1]-3])
+		jobs_win.noutrefresh()
 
 	selected_item = 0
 	
@@ -139,17 +231,25 @@ def main():
 	stdscr.addstr(3, 2+len(logo_name)+6, '  ', logo_attr)
 	stdscr.noutrefresh()
 	
-	#pkl_file = open('data.pkl', 'rb')
-	pkl_file = urllib2.urlopen('http://pirateplay.se/data.pkl')
-	data = pickle.load(pkl_file)
+	try:
+		programmes = catalogue.update(catalogue_url, catalogue_path)
+	except (urllib2.URLError, ValueError, catalogue.CatalogueError):
+		# Offline, or a bad download: the copy from last time will do.
+		programmes = catalogue.Catalogue(catalogue_path)
 	
-	data_list = dict2list(data)
+	data_list = catalogue_list(programmes)
 	menu = Menu(data_list, curses.newwin(10, stdscr.getmaxyx()[1]-2, 5, 2), 0, 0)
 	play_menu = Menu([], curses.newwin(5, 20, 16, 2), 0, 0)
 	
 	help_win = curses.newwin(5, stdscr.getmaxyx()[1]-2, 25, 2)
+	jobs_win = curses.newwin(5, stdscr.getmaxyx()[1]-2, 30, 2)
+	supervisor = Supervisor()
+	streams = StreamCache()
+	showing = None
+	shown = None
+	stdscr.timeout(500)
 	
-	print_help('Navigera med piltangenterna\nQ för att avsluta')
+	print_help('Navigera med piltangenterna\nQ för att avsluta, 1-5 avbryter ett jobb')
 	menu.set_focus(True)
 	curses.doupdate()
 	
@@ -160,21 +260,29 @@ def main():
 		c = stdscr.getch()
 		
 		if c == ord('q'): break
-			
-		if not menu.push_char(c):
+		
+		if c == -1:
+			show_jobs()
+			if showing is not None and play_menu.has_focus and streams.get(showing) != shown:
+				shown = streams.get(showing)
+				play_menu.extend_data(stream_list(*shown))
+		elif ord('1') <= c <= ord('5'):
+			jobs = supervisor.jobs[-5:]
+			if c - ord('1') < len(jobs):
+				supervisor.cancel(jobs[c - ord('1')])
+			show_jobs()
+		elif menu.has_focus and menu.push_char(c):
+			for data in menu.get_nearby('data', 2):
+				if data:
+					streams.want(data)
+		elif menu.has_focus:
 			data = menu.get_current('data')
 			
 			if data:
-				streams = []
-				for rtmp_cmd in remove_duplicates(generate_getcmd(data.encode('utf-8'))):
-					streams.append(
-								{
-									'title' : rtmp_cmd.splitlines()[0],
-									'data' 	: None,
-									'list' 	: [
-											{'title' : 'play', 'data' : rtmp_cmd.splitlines()[1]},
-											{'title' : 'download', 'data' : rtmp_cmd.splitlines()[1]}]})
-				play_menu.set_data(streams)
+				streams.want(data, now = True)
+				showing = data
+				shown = streams.get(data)
+				play_menu.set_data(stream_list(*shown))
 				play_menu.set_focus(True)
 				menu.set_focus(False)
 		elif not play_menu.push_char(c):
@@ -182,24 +290,25 @@ def main():
 			data = play_menu.get_current('data')
 			
 			if title == "play" and data:
-				data.encode('utf-8')
-				rtmpdump_p = subprocess.Popen(shlex.split(data), shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-				mplayer_p = subprocess.Popen(['mplayer', '-'], shell=False, stdin=rtmpdump_p.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+				supervisor.play(data.encode('utf-8'), menu.get_current('title').encode('utf-8'))
+				show_jobs()
 			elif title == "download" and data:
 				print_help('Ange filnamn - avsluta med Enter:\n>')
 				curses.echo()
 				file_name = help_win.getstr(1, 2)
 				curses.noecho()
-				#print_help('Downloading ' + file_name)
-				thread.start_new_thread(download, (file_name, data))
+				supervisor.download(data.encode('utf-8'), file_name)
+				show_jobs()
 			else:
+				showing = None
 				play_menu.set_data([])
 				play_menu.set_focus(False)
 				menu.set_focus(True)
 			
 		
 		curses.doupdate()
-			
+	
+	supervisor.shutdown()
 	restore_screen()
 
 def restore_screen():
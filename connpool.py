@@ -0,0 +1,182 @@
+import cStringIO, httplib, socket, threading, time, urllib2
+
+# Keep-alive HTTP connections shared by the resolver (through
+# PooledHTTPHandler) and the Brightcove/Kanal5 AMF calls (through
+# pool.request).  A connection goes back to the pool once its response
+# has been read to the end; anything else is closed.
+#
+# Timeouts are (connect, read) pairs in seconds; a single number is used
+# for both.
+
+drain_limit = 65536
+
+def split_timeout(timeout):
+	if isinstance(timeout, tuple):
+		return timeout
+	return (timeout, timeout)
+
+class PooledResponse(object):
+	def __init__(self, pool, key, conn, response):
+		self.pool = pool
+		self.key = key
+		self.conn = conn
+		self.response = response
+		self.status = response.status
+		self.reason = response.reason
+		self.msg = response.msg
+		self._buffer = None
+	def getheader(self, name, default = None):
+		return self.response.getheader(name, default)
+	def read(self, amt = None):
+		if self._buffer is not None:
+			return self._buffer.read(amt) if amt is not None else self._buffer.read()
+		data = self.response.read(amt) if amt is not None else self.response.read()
+		if self.response.isclosed():
+			self.close()
+		return data
+	def readline(self):
+		if self._buffer is None:
+			self._buffer = cStringIO.StringIO(self.read())
+		return self._buffer.readline()
+	def readlines(self):
+		return list(iter(self.readline, ''))
+	def abort(self):
+		# Gives up on the rest of the body: the connection is dropped rather
+		# than drained, unless the body happens to have been read already.
+		if self.conn is not None and not self.response.isclosed():
+			self.conn.close()
+			self.conn = None
+		self.close()
+	def close(self):
+		if self.conn is None:
+			return
+		response = self.response
+		if not response.isclosed() and response.length is not None and response.length <= drain_limit:
+			# Draining a short body is cheaper than a new connection.
+			response.read()
+		if response.isclosed() and not self.response.will_close:
+			self.pool.release(self.key, self.conn)
+		else:
+			self.conn.close()
+		self.conn = None
+
+class ConnectionPool(object):
+	def __init__(self, max_idle = 4, max_age = 60, timeout = (10, 30)):
+		self.max_idle = max_idle
+		self.max_age = max_age
+		self.timeout = timeout
+		self.created = 0
+		self.reused = 0
+		self.requests = 0
+		self._idle = {}
+		self._lock = threading.Lock()
+		# Optional function mapping (scheme, host) to the (host, port) to
+		# connect to instead, e.g. a local stub server.
+		self.connect_to = None
+	def _connect(self, key, timeout):
+		scheme, host = key
+		connect, read = split_timeout(timeout)
+		if self.connect_to is not None:
+			conn = httplib.HTTPConnection(*self.connect_to(scheme, host), timeout = connect)
+		elif scheme == 'https':
+			conn = httplib.HTTPSConnection(host, timeout = connect)
+		else:
+			conn = httplib.HTTPConnection(host, timeout = connect)
+		conn.connect()
+		conn.sock.settimeout(read)
+		conn.created = time.time()
+		with self._lock:
+			self.created += 1
+		return conn
+	def acquire(self, key, timeout = None):
+		timeout = timeout or self.timeout
+		now = time.time()
+		with self._lock:
+			idle = self._idle.get(key, [])
+			while idle:
+				conn = idle.pop()
+				if now - conn.created < self.max_age:
+					self.reused += 1
+					conn.sock.settimeout(split_timeout(timeout)[1])
+					return conn, True
+				conn.close()
+		return self._connect(key, timeout), False
+	def release(self, key, conn):
+		with self._lock:
+			idle = self._idle.setdefault(key, [])
+			if len(idle) < self.max_idle and time.time() - conn.created < self.max_age:
+				idle.append(conn)
+				return
+		conn.close()
+	def request(self, method, host, selector, body = None, headers = {}, scheme = 'http', timeout = None):
+		key = (scheme, host)
+		timeout = timeout or self.timeout
+		with self._lock:
+			self.requests += 1
+		conn, reused = self.acquire(key, timeout)
+		try:
+			conn.request(method, selector, body, headers)
+			response = conn.getresponse()
+		except socket.timeout:
+			conn.close()
+			raise
+		except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+			conn.close()
+			if not reused:
+				raise
+			# The server dropped an idle connection; retry on a fresh one.
+			conn = self._connect(key, timeout)
+			conn.request(method, selector, body, headers)
+			response = conn.getresponse()
+		return PooledResponse(self, key, conn, response)
+	def close(self):
+		with self._lock:
+			for idle in self._idle.values():
+				for conn in idle:
+					conn.close()
+			self._idle = {}
+	def stats(self):
+		now = time.time()
+		with self._lock:
+			ages = [now - conn.created for idle in self._idle.values() for conn in idle]
+			return {'hosts': len([idle for idle in self._idle.values() if idle]),
+				'idle': len(ages),
+				'created': self.created,
+				'reused': self.reused,
+				'requests': self.requests,
+				'max_age': max(ages) if ages else 0,
+				'mean_age': sum(ages) / len(ages) if ages else 0}
+
+def pooled_open(pool, parent, req, scheme):
+	headers = dict(parent.addheaders)
+	headers.update(req.headers)
+	headers.update(req.unredirected_hdrs)
+	headers = dict((name.title(), value) for name, value in headers.items())
+	# urllib2 leaves its own default object in req.timeout when no timeout
+	# was given to open().
+	timeout = req.timeout if isinstance(req.timeout, (int, float, tuple)) else None
+	try:
+		response = pool.request(req.get_method(), req.get_host(), req.get_selector(),
+			req.get_data(), headers, scheme, timeout)
+	except socket.error as err:
+		raise urllib2.URLError(err)
+	fp = urllib2.addinfourl(response, response.msg, req.get_full_url())
+	fp.code = response.status
+	fp.msg = response.reason
+	return fp
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+	def __init__(self, pool):
+		urllib2.HTTPHandler.__init__(self)
+		self.pool = pool
+	def http_open(self, req):
+		return pooled_open(self.pool, self.parent, req, 'http')
+
+class PooledHTTPSHandler(urllib2.HTTPSHandler):
+	def __init__(self, pool):
+		urllib2.HTTPSHandler.__init__(self)
+		self.pool = pool
+	def https_open(self, req):
+		return pooled_open(self.pool, self.parent, req, 'https')
+
+pool = ConnectionPool()
@@ -0,0 +1,161 @@
+import re, time
+from extractors import ExtractError
+from services import service
+
+# Chains are indexed by the domain of their first step, so a URL is only
+# tried against the services that can possibly match it.
+
+_url_host = re.compile(r'^(?:[a-z][a-z0-9+.-]*://)?([^/:?#]+)', re.IGNORECASE)
+_pattern_domain = re.compile(r'([a-z0-9\[\]-]+)\\?\.([a-z]{2,3})(?=[/(]|$)')
+
+def url_domain(url):
+	match = _url_host.match(url)
+	if match is None:
+		return None
+	return '.'.join(match.group(1).lower().split('.')[-2:])
+
+def expand_class(label):
+	match = re.search(r'\[([^\]]+)\]', label)
+	if match is None:
+		return [label]
+	if '-' in match.group(1):
+		return None
+	expanded = []
+	for char in match.group(1):
+		expanded += expand_class(label[:match.start()] + char + label[match.end():])
+	return expanded
+
+def pattern_domains(pattern):
+	match = _pattern_domain.search(pattern)
+	if match is None:
+		return None
+	labels = expand_class(match.group(1))
+	if labels is None:
+		return None
+	return ['%s.%s' % (label, match.group(2)) for label in labels]
+
+def compile_step(item):
+	step = dict(item)
+	if '%(' in item['re']:
+		step['compiled'] = None
+	else:
+		step['compiled'] = re.compile(item['re'] % {}, re.DOTALL)
+	return step
+
+def step_re(step, match_vars):
+	if step['compiled'] is not None:
+		return step['compiled']
+	return re.compile(step['re'] % match_vars, re.DOTALL)
+
+# A step gives up once the searches for its matches add up to more than
+# its 'budget' (or step_budget) seconds.  The total is only looked at
+# after each search returns, so this cuts off a step that keeps finding
+# slow matches in a big document; it is not a timeout.  CPython cannot
+# interrupt a search in progress, so a single catastrophically
+# backtracking search still runs to completion before the step is given
+# up, and such a pattern has to be fixed in services.py.
+
+step_budget = 2.0
+
+class BudgetExceeded(Exception):
+	pass
+
+def budgeted(matches, budget):
+	spent = 0.0
+	while True:
+		started = time.time()
+		match = next(matches, None)
+		spent += time.time() - started
+		if spent > budget:
+			raise BudgetExceeded('step matching took over %gs' % budget)
+		if match is None:
+			return
+		yield match.groupdict()
+
+# Steps with a 'stream' entry match against the response while it is
+# being read instead of after reading all of it.  Only the last
+# 'window' (or stream_window) bytes before the current position are
+# kept, so a match longer than that is missed, and a match is only taken
+# once something follows it, so patterns that could extend further with
+# more input (a greedy .* say) do not belong in streamed steps.  With
+# 'stream': N the response is closed as soon as N matches are found;
+# 'stream': True reads it to the end.
+
+chunk_size = 8192
+stream_window = 16384
+
+def stream_matches(regex, body, step):
+	wanted = step['stream'] if step['stream'] is not True else None
+	window = step.get('window', stream_window)
+	budget = step.get('budget', step_budget)
+	spent = 0.0
+	found = 0
+	buf = ''
+	pos = 0
+	eof = False
+	try:
+		while wanted is None or found < wanted:
+			started = time.time()
+			match = regex.search(buf, pos)
+			spent += time.time() - started
+			if spent > budget:
+				raise BudgetExceeded('step matching took over %gs' % budget)
+			if match is not None and (eof or match.end() < len(buf)):
+				pos = match.end() if match.end() > match.start() else match.end() + 1
+				found += 1
+				yield match.groupdict()
+				continue
+			if eof:
+				return
+			chunk = body.read(chunk_size)
+			eof = not chunk
+			keep = max(pos, len(buf) - window)
+			if match is not None:
+				keep = min(keep, match.start())
+			buf = buf[keep:] + chunk
+			pos -= keep
+		body.abort()
+	finally:
+		body.close()
+
+def step_matches(step, match_vars, content):
+	# The group dicts of a step's matches: from its extractor if it has one
+	# that finds anything, otherwise from its regular expression.
+	if hasattr(content, 'read'):
+		if 'stream' in step:
+			return stream_matches(step_re(step, match_vars), content, step)
+		content = content.read()
+	if 'extract' in step:
+		try:
+			found = step['extract'](content, match_vars)
+		except ExtractError:
+			found = None
+		if found:
+			return iter(found)
+	return budgeted(step_re(step, match_vars).finditer(content), step.get('budget', step_budget))
+
+def chain_name(index, steps):
+	if 'service-name' in steps[0]:
+		return steps[0]['service-name']
+	match = _pattern_domain.search(steps[0]['re'])
+	return '%s#%d' % (match.group(0).replace('\\', '') if match else 'chain', index)
+
+def build_index(chains):
+	by_domain = {}
+	wildcard = []
+	for index, (name, steps) in enumerate(chains):
+		domains = pattern_domains(steps[0]['re'])
+		if domains is None:
+			wildcard.append(index)
+		else:
+			for domain in domains:
+				by_domain.setdefault(domain, []).append(index)
+	return dict((domain, [chains[index] for index in sorted(indices + wildcard)])
+			for domain, indices in by_domain.items())
+
+def candidates(url):
+	return index.get(url_domain(url), chains)
+
+chains = [(chain_name(index, steps), [compile_step(item) for item in steps])
+		for index, steps in enumerate(service)]
+index = build_index(chains)
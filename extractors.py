@@ -0,0 +1,120 @@
+import json, re
+from cStringIO import StringIO
+from xml.etree import cElementTree
+
+# Structured alternatives to a step's 're'.  A step with an 'extract'
+# entry gets its matches from the extractor, which parses the document
+# once instead of rescanning it for every match; if the document does
+# not parse, or the extractor finds nothing, the step falls back to its
+# regular expression.
+#
+# An extractor is called with (content, match_vars) and returns a list
+# of dicts, used like the groupdict() of a regex match.  Both kinds below
+# take:
+#
+#    fields   {group: path}, read relative to each item
+#    context  {group: path or (path, pattern)}, read once per document
+#    where    {group: pattern}, items whose field does not match are
+#             skipped; patterns are formatted with the match variables
+
+class ExtractError(Exception):
+	pass
+
+def text(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	if isinstance(value, bool):
+		return str(value).lower()
+	return str(value)
+
+def accept(groups, where, match_vars):
+	for group, pattern in where.items():
+		if groups.get(group) is None or not re.search(pattern % match_vars, groups[group]):
+			return False
+	return True
+
+def walk(node):
+	# Every dict in a decoded JSON document; list items stay in order.
+	if isinstance(node, dict):
+		yield node
+		for value in node.values():
+			for child in walk(value):
+				yield child
+	elif isinstance(node, list):
+		for value in node:
+			for child in walk(value):
+				yield child
+
+def descend(node, path):
+	for key in path:
+		if isinstance(node, list):
+			try:
+				node = node[int(key)]
+			except (ValueError, IndexError):
+				return None
+		elif isinstance(node, dict) and key in node:
+			node = node[key]
+		else:
+			return None
+	return node
+
+def find(document, path, pattern = None):
+	# The first value at path, whose first key may sit at any depth.
+	path = path.split('.')
+	for node in walk(document):
+		if path[0] in node:
+			value = descend(node[path[0]], path[1:])
+			if value is not None and (pattern is None or re.search(pattern, text(value))):
+				return text(value)
+	return None
+
+def json_objects(fields, context = {}, where = {}):
+	# Every JSON object that has all the given fields.
+	def extract(content, match_vars):
+		try:
+			document = json.loads(content)
+		except ValueError as err:
+			raise ExtractError(err)
+		shared = {}
+		for group, path in context.items():
+			shared[group] = find(document, *(path if isinstance(path, tuple) else (path,)))
+		found = []
+		for node in walk(document):
+			values = [descend(node, path.split('.')) for path in fields.values()]
+			if None in values:
+				continue
+			groups = dict(shared)
+			groups.update(zip(fields.keys(), [text(value) for value in values]))
+			if accept(groups, where, match_vars):
+				found.append(groups)
+		return found
+	return extract
+
+def xml_elements(tag, fields, context = {}, where = {}):
+	# Every <tag> element, with fields read from the text of its children.
+	# The document is parsed incrementally and each element is discarded
+	# once read.
+	def extract(content, match_vars):
+		shared = {}
+		items = []
+		try:
+			for event, element in cElementTree.iterparse(StringIO(content)):
+				for group, path in context.items():
+					name, pattern = path if isinstance(path, tuple) else (path, None)
+					if group not in shared and element.tag == name and element.text:
+						if pattern is None or re.search(pattern, element.text):
+							shared[group] = text(element.text.strip())
+				if element.tag == tag:
+					values = [element.findtext(path) for path in fields.values()]
+					if None not in values:
+						items.append(dict(zip(fields.keys(), [text(value.strip()) for value in values])))
+					element.clear()
+		except SyntaxError as err:
+			raise ExtractError(err)
+		found = []
+		for groups in items:
+			groups.update((group, value) for group, value in shared.items() if group not in groups)
+			if accept(groups, where, match_vars):
+				found.append(groups)
+		return found
+	return extract
@@ -0,0 +1,112 @@
+import threading, time
+from collections import OrderedDict
+
+# Per-chain health, consulted by the resolver before it tries a chain.
+#
+# A chain whose fetches keep failing (connection errors, timeouts, 5xx
+# responses) without producing anything trips a circuit breaker and is
+# skipped for everybody for a cooldown that doubles every time it trips
+# again.  Once the cooldown is over a single resolve is let through as a
+# trial; success closes the breaker, another failure opens it again.
+#
+# A chain that matched nothing for a URL, or got a 4xx for it, is remembered
+# in a negative cache for that URL only, with the same doubling backoff,
+# since the same chain may well work for other URLs.
+
+class ChainState(object):
+	__slots__ = ('failures', 'trips', 'open_until', 'trial_started', 'last_error')
+
+	def __init__(self):
+		self.failures = 0
+		self.trips = 0
+		self.open_until = None
+		self.trial_started = None
+		self.last_error = None
+
+class HealthTracker(object):
+	def __init__(self, threshold = 3, cooldown = 60, max_cooldown = 3600,
+			empty_ttl = 600, max_empty_ttl = 86400, size = 4096):
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.max_cooldown = max_cooldown
+		self.empty_ttl = empty_ttl
+		self.max_empty_ttl = max_empty_ttl
+		self.size = size
+		self.skipped = 0
+		self._chains = {}
+		self._empty = OrderedDict()
+		self._lock = threading.Lock()
+
+	def allow(self, name, url):
+		now = time.time()
+		with self._lock:
+			allowed = self._allow(name, url, now)
+			if not allowed:
+				self.skipped += 1
+			return allowed
+	def _allow(self, name, url, now):
+		entry = self._empty.get((name, url))
+		if entry is not None:
+			if entry[1] > now:
+				return False
+		chain = self._chains.get(name)
+		if chain is None or chain.open_until is None:
+			return True
+		if now < chain.open_until:
+			return False
+		# Half-open: one trial at a time, and a new one if the last trial
+		# never reported back.
+		if chain.trial_started is not None and now - chain.trial_started < self.cooldown:
+			return False
+		chain.trial_started = now
+		return True
+
+	def success(self, name, url):
+		with self._lock:
+			self._chains.pop(name, None)
+			self._empty.pop((name, url), None)
+
+	def failure(self, name, error):
+		now = time.time()
+		with self._lock:
+			chain = self._chains.setdefault(name, ChainState())
+			chain.failures += 1
+			chain.last_error = error
+			if chain.trial_started is not None or chain.failures >= self.threshold:
+				chain.trips += 1
+				chain.open_until = now + min(self.cooldown * 2 ** (chain.trips - 1), self.max_cooldown)
+				chain.trial_started = None
+
+	def empty(self, name, url):
+		now = time.time()
+		with self._lock:
+			count = self._empty.pop((name, url), (0, None))[0] + 1
+			ttl = min(self.empty_ttl * 2 ** (count - 1), self.max_empty_ttl)
+			self._empty[(name, url)] = (count, now + ttl)
+			while len(self._empty) > self.size:
+				self._empty.popitem(last = False)
+
+	def reset(self):
+		with self._lock:
+			self._chains = {}
+			self._empty = OrderedDict()
+
+	def stats(self):
+		now = time.time()
+		with self._lock:
+			chains = {}
+			for name, chain in self._chains.items():
+				if chain.open_until is None:
+					state = 'closed'
+				elif now < chain.open_until:
+					state = 'open'
+				else:
+					state = 'half-open'
+				chains[name] = {'state': state,
+					'failures': chain.failures,
+					'trips': chain.trips,
+					'retry_in': max(0, chain.open_until - now) if chain.open_until else 0,
+					'last_error': chain.last_error}
+			return {'chains': chains,
+				'negative': len([entry for entry in self._empty.values() if entry[1] > now]),
+				'skipped': self.skipped}
@@ -0,0 +1,216 @@
+import json, os, socket, threading, time, urllib2, urlparse
+
+# In-process downloads of plain HTTP streams.  When the server honours
+# Range requests the file is split into segments fetched in parallel,
+# each written at its own offset of a preallocated .tmp file.  Progress
+# per segment is kept in a .parts file next to it, so an interrupted
+# download resumes where every segment left off.  The finished file must
+# be exactly as long as the server said before it is renamed into place.
+
+segments = 4
+min_segment = 1 << 20
+chunk_size = 65536
+timeout = 30
+retries = 3
+save_interval = 2
+
+class DownloadError(Exception):
+	pass
+
+def content_range_total(value):
+	try:
+		return int(value.rpartition('/')[2])
+	except (AttributeError, ValueError):
+		return None
+
+def validator(info):
+	return info.get('ETag') or info.get('Last-Modified')
+
+manifests = ('.m3u8', '.f4m', '.mpd', '.ism')
+
+def progressive(url):
+	# A plain media file rather than a playlist that needs a segmenting client.
+	path = urlparse.urlparse(url).path.lower()
+	return urlparse.urlparse(url).scheme in ('http', 'https') and not path.endswith(manifests)
+
+def split(total, count):
+	size = max(1, -(-total // count))
+	return [[start, min(start + size, total) - 1, 0] for start in range(0, total, size)]
+
+class Download(object):
+	def __init__(self, url, path, tmppath, headers, progress, throttle):
+		self.url = url
+		self.path = path
+		self.tmppath = tmppath
+		self.partspath = tmppath + '.parts'
+		self.headers = headers
+		self.progress = progress
+		self.throttle = throttle
+		self.total = None
+		self.validator = None
+		self.segments = []
+		self.done = 0
+		self.saved = 0
+		self._lock = threading.Lock()
+
+	def request(self, byte_range = None):
+		req = urllib2.Request(self.url, headers = self.headers)
+		if byte_range is not None:
+			req.add_header('Range', 'bytes=%d-%d' % byte_range)
+			if self.validator:
+				req.add_header('If-Range', self.validator)
+		return urllib2.urlopen(req, timeout = timeout)
+
+	def load_parts(self):
+		try:
+			with open(self.partspath) as f:
+				parts = json.load(f)
+		except (IOError, ValueError):
+			return None
+		return parts
+
+	def save_parts(self):
+		with open(self.partspath + '.new', 'w') as f:
+			json.dump({'url': self.url, 'total': self.total, 'validator': self.validator,
+				'segments': self.segments}, f)
+		os.rename(self.partspath + '.new', self.partspath)
+		self.saved = time.time()
+
+	def advance(self, nbytes):
+		with self._lock:
+			self.done += nbytes
+		if self.progress is not None:
+			self.progress(self.done, self.total)
+		if self.throttle is not None:
+			pause = self.throttle(nbytes)
+			if pause > 0:
+				time.sleep(pause)
+
+	def persist(self, segment, position, f):
+		# Only bytes that have reached the disk are recorded as done, or a
+		# resume after a crash would leave holes in the file.
+		f.flush()
+		os.fsync(f.fileno())
+		with self._lock:
+			segment[2] = position - segment[0]
+			self.save_parts()
+
+	def write(self, response, segment, f):
+		start, end, done = segment
+		position = start + done
+		f.seek(position)
+		try:
+			while end is None or position <= end:
+				size = chunk_size if end is None else min(chunk_size, end - position + 1)
+				data = response.read(size)
+				if not data:
+					if end is None:
+						return
+					raise DownloadError('connection closed %d bytes short' % (end - position + 1))
+				f.write(data)
+				position += len(data)
+				self.advance(len(data))
+				if time.time() - self.saved >= save_interval:
+					self.persist(segment, position, f)
+		finally:
+			self.persist(segment, position, f)
+
+	def fetch_segment(self, segment):
+		for attempt in range(retries + 1):
+			start, end, done = segment
+			if start + done > end:
+				return
+			try:
+				response = self.request((start + done, end))
+				if response.code != 206:
+					raise DownloadError('%s changed or stopped honouring ranges' % self.url)
+				with open(self.tmppath, 'r+b') as f:
+					self.write(response, segment, f)
+				response.close()
+				return
+			except (urllib2.URLError, socket.error, DownloadError):
+				if attempt == retries:
+					raise
+				time.sleep(2 ** attempt)
+
+	def plan(self, count):
+		# Probes with a one byte range, which also tells whether ranges
+		# work at all; the probe response is kept for a plain download.
+		response = self.request((0, 0))
+		info = response.info()
+		if response.code == 206:
+			self.total = content_range_total(info.get('Content-Range'))
+			self.validator = validator(info)
+			response.close()
+		else:
+			length = info.get('Content-Length')
+			self.total = int(length) if length else None
+			return response
+		if self.total is None:
+			return self.request()
+
+		parts = self.load_parts()
+		if (parts is not None and os.path.exists(self.tmppath) and parts['url'] == self.url
+				and parts['total'] == self.total and parts['validator'] == self.validator):
+			self.segments = parts['segments']
+		else:
+			# Without a matching .parts file nothing in an old .tmp can be
+			# trusted to belong to this version of the file.
+			self.segments = split(self.total, max(1, min(count, self.total // min_segment)))
+			open(self.tmppath, 'wb').close()
+		self.done = sum(segment[2] for segment in self.segments)
+		# Reserves the whole file up front (sparse where the filesystem
+		# allows it), so segments can be written at their offsets.
+		with open(self.tmppath, 'r+b') as f:
+			f.truncate(self.total)
+		self.save_parts()
+		return None
+
+	def run(self, count):
+		response = self.plan(count)
+		if response is not None:
+			# No ranges: one connection from the start, over any old .tmp.
+			self.segments = [[0, None if self.total is None else self.total - 1, 0]]
+			with open(self.tmppath, 'wb') as f:
+				if self.total:
+					f.truncate(self.total)
+				self.write(response, self.segments[0], f)
+			response.close()
+		else:
+			errors = []
+			def worker(segment):
+				try:
+					self.fetch_segment(segment)
+				except Exception as err:
+					errors.append(err)
+			threads = [threading.Thread(target = worker, args = (segment,)) for segment in self.segments
+				if segment[0] + segment[2] <= segment[1]]
+			for thread in threads:
+				thread.daemon = True
+				thread.start()
+			for thread in threads:
+				while thread.is_alive():
+					thread.join(1)
+			with self._lock:
+				self.save_parts()
+			if errors:
+				raise errors[0]
+
+		size = os.path.getsize(self.tmppath)
+		if self.total is not None and (size != self.total or self.done != self.total):
+			raise DownloadError('got %d of %d bytes' % (self.done, self.total))
+		os.rename(self.tmppath, self.path)
+		if os.path.exists(self.partspath):
+			os.unlink(self.partspath)
+
+def download(url, path, tmppath = None, count = None, headers = {}, progress = None, throttle = None):
+	# progress(done, total) is called as bytes arrive; throttle(nbytes), if
+	# given, returns how many seconds to pause after them.
+	Download(url, path, tmppath or path + '.tmp', dict(headers), progress, throttle).run(count or segments)
+
+if __name__ == '__main__':
+	import sys
+	def show(done, total):
+		sys.stderr.write('\r%d / %s bytes' % (done, total or '?'))
+	download(sys.argv[1], sys.argv[2], progress = show)
+	sys.stderr.write('\n')
@@ -1,4 +1,4 @@
-import httplib
+from connpool import pool
 from pyamf import remoting
 
 def get_kanal5(video_player):
@@ -19,9 +19,7 @@ def get_kanal5(video_player):
 	)
 	env = str(remoting.encode(env).read())
 
-	conn = httplib.HTTPConnection("c.brightcove.com")
-	conn.request("POST", "/services/messagebroker/amf?playerKey=AQ~~,AAAABUmivxk~,SnCsFJuhbr0vfwrPJJSL03znlhz-e9bk", env, {'content-type': 'application/x-amf'})
-	response = conn.getresponse().read()
+	response = pool.request("POST", "c.brightcove.com", "/services/messagebroker/amf?playerKey=AQ~~,AAAABUmivxk~,SnCsFJuhbr0vfwrPJJSL03znlhz-e9bk", env, {'content-type': 'application/x-amf'}).read()
 	rtmp = ''
 	for rendition in remoting.decode(response).bodies[0][1].body['renditions']:
 		rtmp += '"%sx%s:%s";' % (rendition['frameWidth'], rendition['frameHeight'], rendition['defaultURL'])
@@ -0,0 +1,296 @@
+import errno, fcntl, os, re, select, shlex, subprocess, threading, time
+import httpget
+
+# The curses client's downloads and playback, run as jobs under one
+# supervisor thread.  The supervisor owns every child process: it reads
+# their progress from stderr through select(), relays a player's input
+# from its producer (rtmpdump) through a bounded ring buffer, and reaps
+# them when they exit or are cancelled.  A producer that gets ahead of
+# its player simply stops being read once the buffer is full, so it
+# blocks on its pipe instead of growing the client's memory.  Plain
+# HTTP downloads go through httpget on a thread of their own.
+
+RTMPDUMP_PROGRESS = re.compile(r'([\d.]+) kB / [\d.]+ sec(?: \(([\d.]+)%\))?')
+
+buffer_size = 4 << 20
+chunk_size = 65536
+poll_interval = 0.5
+grace = 2
+history = 5
+
+class Cancelled(Exception):
+	pass
+
+class RingBuffer(object):
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.size = 0
+		self._data = bytearray(capacity)
+		self._start = 0
+
+	def free(self):
+		return self.capacity - self.size
+
+	def write(self, data):
+		# Stores as much of data as fits and returns how much that was.
+		n = min(len(data), self.free())
+		end = (self._start + self.size) % self.capacity
+		first = min(n, self.capacity - end)
+		self._data[end:end + first] = data[:first]
+		self._data[:n - first] = data[first:n]
+		self.size += n
+		return n
+
+	def peek(self, n):
+		# Up to n of the oldest bytes, without wrapping around.
+		return bytes(self._data[self._start:self._start + min(n, self.size, self.capacity - self._start)])
+
+	def consume(self, n):
+		self._start = (self._start + n) % self.capacity
+		self.size -= n
+
+def nonblocking(f):
+	fd = f.fileno()
+	fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+	return fd
+
+class Job(object):
+	def __init__(self, kind, label):
+		self.kind = kind
+		self.label = label
+		self.state = 'running'
+		self.error = None
+		self.percent = None
+		self.kbytes = 0
+		self.processes = []
+		self.progress = {}
+		self.source = self.sink = None
+		self.ring = None
+		self.cancelled = False
+		self.kill_at = None
+
+	def running(self):
+		return self.state == 'running'
+
+	def parse(self, line):
+		match = RTMPDUMP_PROGRESS.search(line)
+		if match is not None:
+			self.kbytes = float(match.group(1))
+			if match.group(2) is not None:
+				self.percent = float(match.group(2))
+
+	def status(self):
+		if self.state != 'running':
+			return '%s %s: %s' % (self.kind, self.label, self.error or self.state)
+		if self.percent is not None:
+			return '%s %s: %.1f%%' % (self.kind, self.label, self.percent)
+		return '%s %s: %d kB' % (self.kind, self.label, self.kbytes)
+
+class Supervisor(object):
+	def __init__(self):
+		self.jobs = []
+		self._lock = threading.Lock()
+		self._wake_r, self._wake_w = os.pipe()
+		self._devnull = open(os.devnull, 'r+')
+		self._stopped = False
+		self._thread = threading.Thread(target = self._loop)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _add(self, job):
+		with self._lock:
+			# Finished jobs are kept for a while to show how they ended.
+			finished = [other for other in self.jobs if not other.running()][:-history or None]
+			self.jobs = [other for other in self.jobs if other not in finished] + [job]
+		os.write(self._wake_w, 'x')
+		return job
+
+	def _spawn(self, job, argv, **kwargs):
+		process = subprocess.Popen(argv, stderr = subprocess.PIPE, close_fds = True, **kwargs)
+		job.processes.append(process)
+		job.progress[nonblocking(process.stderr)] = (process.stderr, '')
+		return process
+
+	def download(self, cmd, filename):
+		job = Job('download', os.path.basename(filename))
+		if httpget.progressive(cmd):
+			def progress(done, total):
+				if job.cancelled:
+					raise Cancelled()
+				job.kbytes = done / 1024.0
+				if total:
+					job.percent = 100.0 * done / total
+			def run():
+				try:
+					httpget.download(cmd.strip(), filename, progress = progress)
+					job.state = 'done'
+				except Cancelled:
+					job.state = 'cancelled'
+				except Exception as err:
+					job.state, job.error = 'failed', str(err)
+			thread = threading.Thread(target = run)
+			thread.daemon = True
+			thread.start()
+			return self._add(job)
+		try:
+			self._spawn(job, shlex.split(cmd) + ['-o', filename], stdin = self._devnull, stdout = self._devnull)
+		except OSError as err:
+			job.state, job.error = 'failed', str(err)
+		return self._add(job)
+
+	def play(self, cmd, label):
+		job = Job('play', label)
+		try:
+			if cmd.startswith('rtmpdump'):
+				producer = self._spawn(job, shlex.split(cmd), stdin = self._devnull, stdout = subprocess.PIPE)
+				player = self._spawn(job, ['mplayer', '-'], stdin = subprocess.PIPE, stdout = self._devnull)
+				job.source = (nonblocking(producer.stdout), producer.stdout)
+				job.sink = (nonblocking(player.stdin), player.stdin)
+				job.ring = RingBuffer(buffer_size)
+			else:
+				self._spawn(job, ['mplayer', cmd.strip()], stdin = self._devnull, stdout = self._devnull)
+		except OSError as err:
+			job.state, job.error = 'failed', str(err)
+			for process in job.processes:
+				process.kill()
+				process.wait()
+		return self._add(job)
+
+	def cancel(self, job):
+		job.cancelled = True
+		self._terminate(job)
+		os.write(self._wake_w, 'x')
+
+	def _terminate(self, job):
+		for process in job.processes:
+			if process.poll() is None:
+				try:
+					process.terminate()
+				except OSError:
+					pass
+		if job.kill_at is None:
+			job.kill_at = time.time() + grace
+
+	def active(self):
+		with self._lock:
+			return [job for job in self.jobs if job.running()]
+
+	def shutdown(self):
+		for job in self.active():
+			self.cancel(job)
+		deadline = time.time() + grace + 1
+		while self.active() and time.time() < deadline:
+			time.sleep(0.1)
+		self._stopped = True
+		os.write(self._wake_w, 'x')
+		self._thread.join(1)
+
+	def _close(self, job, end):
+		fd, f = getattr(job, end)
+		setattr(job, end, None)
+		try:
+			f.close()
+		except IOError:
+			pass
+
+	def _read_progress(self, job, fd):
+		f, line = job.progress[fd]
+		try:
+			data = os.read(fd, 4096)
+		except OSError as err:
+			if err.errno == errno.EAGAIN:
+				return
+			data = ''
+		if not data:
+			del job.progress[fd]
+			f.close()
+			return
+		# rtmpdump redraws its progress line with \r.
+		for char in data:
+			if char in '\r\n':
+				job.parse(line)
+				line = ''
+			else:
+				line += char
+		job.progress[fd] = (f, line[-512:])
+
+	def _fill(self, job):
+		try:
+			data = os.read(job.source[0], min(chunk_size, job.ring.free()))
+		except OSError as err:
+			if err.errno == errno.EAGAIN:
+				return
+			data = ''
+		if not data:
+			self._close(job, 'source')
+		else:
+			job.ring.write(data)
+
+	def _drain(self, job):
+		try:
+			job.ring.consume(os.write(job.sink[0], job.ring.peek(chunk_size)))
+		except OSError as err:
+			if err.errno == errno.EAGAIN:
+				return
+			# The player is gone; so is the point of the producer.
+			self._close(job, 'sink')
+			self._terminate(job)
+
+	def _reap(self, job, now):
+		if job.source is None and job.sink is not None and not job.ring.size:
+			self._close(job, 'sink')
+		if job.kill_at is not None and now >= job.kill_at:
+			for process in job.processes:
+				if process.poll() is None:
+					try:
+						process.kill()
+					except OSError:
+						pass
+		codes = [process.poll() for process in job.processes]
+		if not job.processes or None in codes:
+			return
+		for fd in job.progress.keys():
+			self._read_progress(job, fd)
+		for f, line in job.progress.values():
+			f.close()
+		job.progress = {}
+		for end in ('source', 'sink'):
+			if getattr(job, end) is not None:
+				self._close(job, end)
+		if job.cancelled:
+			job.state = 'cancelled'
+		elif job.kind == 'play' or codes == [0] * len(codes):
+			job.state = 'done'
+		else:
+			job.state, job.error = 'failed', 'exit status %s' % max(codes)
+
+	def _loop(self):
+		while not self._stopped:
+			readable, writable, owners = [self._wake_r], [], {}
+			with self._lock:
+				jobs = [job for job in self.jobs if job.running() and job.processes]
+			for job in jobs:
+				for fd in job.progress:
+					readable.append(fd)
+					owners[fd] = (job, self._read_progress)
+				if job.source is not None and job.ring.free():
+					readable.append(job.source[0])
+					owners[job.source[0]] = (job, lambda job, fd: self._fill(job))
+				if job.sink is not None and job.ring.size:
+					writable.append(job.sink[0])
+					owners[job.sink[0]] = (job, lambda job, fd: self._drain(job))
+			try:
+				readable, writable, errors = select.select(readable, writable, [], poll_interval)
+			except select.error as err:
+				if err.args[0] == errno.EINTR:
+					continue
+				raise
+			for fd in readable + writable:
+				if fd == self._wake_r:
+					os.read(fd, 512)
+				elif fd in owners:
+					job, handle = owners[fd]
+					handle(job, fd)
+			now = time.time()
+			for job in jobs:
+				self._reap(job, now)
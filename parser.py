@@ -1,10 +1,13 @@
 # coding=utf8
 
-import json, pickle, sys, urllib2, xml.sax
+import hashlib, json, multiprocessing, os, sys, urllib2, xml.sax
+from multiprocessing.pool import ThreadPool
 
 import tidylib
 from PyQt4 import QtCore, QtXmlPatterns, QtNetwork
 
+import catalogue
+
 class EpisodeListHandler(xml.sax.ContentHandler):
 	def __init__(self):
 		self.episode_list = {}
@@ -21,11 +24,8 @@ class EpisodeListHandler(xml.sax.ContentHandler):
 		pass#self.curr_data += ch
 
 class ProgramListHandler(xml.sax.ContentHandler):
-	def __init__(self, episode_query, episode_tidy_opts, episode_encoding):
-		self.programlist = {}
-		self.episode_query = episode_query
-		self.episode_tidy_opts = episode_tidy_opts
-		self.episode_encoding = episode_encoding
+	def __init__(self):
+		self.programlist = []
 		pass
 	def startElement(self, name, attrs):
 		self.curr_data = ""
@@ -33,27 +33,56 @@ class ProgramListHandler(xml.sax.ContentHandler):
 			self.curr_program = {'title' : attrs.get('title'), 'href' : attrs.get('href')}
 	def endElement(self, name):
 		if name == 'program':
-			print "Processing " + '\033[31m' + self.curr_program['title'] + '\033[0m'
-			
-			try:
-				xml_data = http_xquery(self.curr_program['href'], self.episode_query, self.episode_tidy_opts, self.episode_encoding)
-			
-				self.listhandler = EpisodeListHandler()
-				self.sax_parser = xml.sax.make_parser()
-				self.sax_parser.setContentHandler(self.listhandler)
-				xml.sax.parseString(xml_data.encode('utf8'), self.listhandler)
-				#self.curr_program.update({'list' : self.listhandler.episode_list })
-				
-				self.programlist.update({self.curr_program['title'] : self.listhandler.episode_list})
-			except (urllib2.HTTPError, urllib2.URLError):
-				print "HTTP Error: Couldn't fetch " + self.curr_program['title']
-			
+			self.programlist.append(self.curr_program)
 	def characters(self, ch):
 		pass#self.curr_data += ch
 
-def http_xquery(url, query, tidy_opts = None, encoding = 'utf8'):
-	document = urllib2.urlopen(url).read()
+def fetch_document(url):
+	return urllib2.urlopen(url).read()
+
+def fetch_changed(url, pages, salt = '', force = False):
+	# The page at url, or None if it is the same as at the last harvest:
+	# either the server answers a conditional request with 304, or the
+	# content hashes the same.  salt stands for the query the page is run
+	# through, so a changed query counts as a changed page.
+	page = pages.setdefault(url, {})
+	query = hashlib.sha1(salt).hexdigest()
+	force = force or page.get('query') != query
+	req = urllib2.Request(url)
+	if not force:
+		if page.get('etag'):
+			req.add_header('If-None-Match', page['etag'])
+		if page.get('last_modified'):
+			req.add_header('If-Modified-Since', page['last_modified'])
+	try:
+		response = urllib2.urlopen(req)
+	except urllib2.HTTPError as err:
+		if err.code == 304:
+			return None
+		raise
+	document = response.read()
+	info = response.info()
+	content_hash = hashlib.sha1(document).hexdigest()
+	unchanged = not force and page.get('hash') == content_hash
+	page.update(etag = info.get('ETag'), last_modified = info.get('Last-Modified'), hash = content_hash, query = query)
 	
+	if unchanged:
+		return None
+	return document
+
+def load_pages(path):
+	try:
+		return json.load(open(path))
+	except (IOError, ValueError):
+		return {}
+
+def save_pages(path, pages):
+	output = open(path + '.new', 'wb')
+	json.dump(pages, output)
+	output.close()
+	os.rename(path + '.new', path)
+
+def xquery(document, query, tidy_opts = None, encoding = 'utf8'):
 	if not tidy_opts == None:
 		document, tidy_errors = tidylib.tidy_document(document, tidy_opts)
 	
@@ -64,6 +93,9 @@ def http_xquery(url, query, tidy_opts = None, encoding = 'utf8'):
 	
 	return xml_data
 
+def http_xquery(url, query, tidy_opts = None, encoding = 'utf8'):
+	return xquery(fetch_document(url), query, tidy_opts, encoding)
+
 rss_query = """
 		let $items := /rss/channel/item
 		return
@@ -138,29 +170,113 @@ programming = {
 						'episode_query'	:	rss_query,
 						'episode_encoding':	'latin-1'} }
 
-app = QtCore.QCoreApplication(sys.argv)
-qt_query = QtXmlPatterns.QXmlQuery()
-
 tidylib.BASE_OPTIONS = {}
 
-def parse_programming(service):
-	xml_data = http_xquery(service['url'], service['program_query'], service['program_tidy_opts'])
-	print xml_data
+# Harvesting: fetches are I/O bound and run on a pool of threads, across
+# all channels at once; tidying and XQuery are CPU bound and run on a pool
+# of processes, each with its own Qt application.  Programmes go into the
+# catalogue as they finish.
+#
+# Validators and content hashes of every page are kept in harvest.json
+# between runs, with each channel's programme list.  Pages that have not
+# changed are neither tidied nor queried: their programme lists come from
+# harvest.json and their episodes are copied from the last catalogue.
 
-	listhandler = ProgramListHandler(service['episode_query'], service['episode_tidy_opts'], service['episode_encoding'])
+fetch_workers = 16
+query_workers = multiprocessing.cpu_count()
+
+def init_query_worker():
+	global app
+	app = QtCore.QCoreApplication(sys.argv)
+
+def parse_list(xml_data, handler):
 	sax_parser = xml.sax.make_parser()
-	sax_parser.setContentHandler(listhandler)
-	xml.sax.parseString(xml_data.encode('utf8'), listhandler)
+	sax_parser.setContentHandler(handler)
+	xml.sax.parseString(xml_data.encode('utf8'), handler)
+	return handler
+
+def parse_programming(service, queries, pages):
+	salt = repr((service['program_query'], service['program_tidy_opts']))
+	known = 'programs' in pages.get(service['url'], {})
+	document = fetch_changed(service['url'], pages, salt, force = not known)
+	if document is None:
+		return pages[service['url']]['programs']
+	
+	xml_data = queries.apply(xquery, (document, service['program_query'], service['program_tidy_opts']))
+	print xml_data
+	
+	programs = parse_list(xml_data, ProgramListHandler()).programlist
+	pages[service['url']]['programs'] = programs
+	return programs
+
+def parse_episodes(service, program, queries, pages, known):
+	# The programme's episodes, or None if it has not changed or could not
+	# be fetched.
+	salt = repr((service['episode_query'], service['episode_tidy_opts'], service['episode_encoding']))
+	try:
+		document = fetch_changed(program['href'], pages, salt, force = not known)
+	except (urllib2.HTTPError, urllib2.URLError):
+		print "HTTP Error: Couldn't fetch " + program['title']
+		return None
+	if document is None:
+		return None
+	
+	print "Processing " + '\033[31m' + program['title'] + '\033[0m'
+	xml_data = queries.apply(xquery, (document, service['episode_query'], service['episode_tidy_opts'], service['episode_encoding']))
+	
+	return parse_list(xml_data, EpisodeListHandler()).episode_list
+
+def harvest(channels, writer, pages, previous = None):
+	# Returns the harvested data and how many programmes changed.
+	queries = multiprocessing.Pool(query_workers, init_query_worker)
+	fetches = ThreadPool(fetch_workers)
+	data = {}
+	changed = 0
+	try:
+		def known(channel, title):
+			return previous is not None and previous.has(channel, title)
+		def programs(channel):
+			return [(channel, program) for program in parse_programming(programming[channel], queries, pages)]
+		def episodes(item):
+			channel, program = item
+			return channel, program, parse_episodes(programming[channel], program, queries, pages, known(channel, program['title']))
+		
+		items = [item for found in fetches.imap_unordered(programs, channels) for item in found]
+		for channel, program, episode_list in fetches.imap_unordered(episodes, items):
+			title = program['title']
+			if episode_list is not None:
+				writer.add(channel, title, episode_list)
+				changed += 1
+			elif known(channel, title):
+				# Unchanged, or unreachable this time: last harvest's will do.
+				writer.copy(channel, title, previous)
+				episode_list = previous.episodes(channel, title)
+			else:
+				continue
+			data.setdefault(channel, {})[title] = episode_list
+	finally:
+		fetches.close()
+		queries.close()
+		queries.join()
+	return data, changed
+
+if __name__ == '__main__':
+	pages = load_pages('harvest.json')
+	try:
+		previous = catalogue.Catalogue('catalogue.dat')
+	except (IOError, catalogue.CatalogueError):
+		previous = None
 	
-	return listhandler.programlist
-
-data = {}
-data.update({'SVT' : parse_programming(programming['SVT'])})
-data.update({'TV3' : parse_programming(programming['TV3'])})
-#data.append({'title' : 'TV4', 'list' : parse_programming(programming['TV4'])})
-output = open('data.pkl', 'wb')
-pickle.dump(data, output)
-output.close()
-output = open('data.json', 'wb')
-json.dump(data, output)
-output.close()
\ No newline at end of file
+	#TV4 is left out: parse_programming(programming['TV4'])
+	writer = catalogue.Writer('catalogue.dat')
+	data, changed = harvest(['SVT', 'TV3'], writer, pages, previous)
+	listed = dict((channel, sorted(programs)) for channel, programs in data.items())
+	if previous is None or changed or listed != dict((channel, previous.programmes(channel)) for channel in previous.channels()):
+		writer.close()
+		output = open('data.json', 'wb')
+		json.dump(data, output)
+		output.close()
+	else:
+		print "Nothing changed"
+		writer.discard()
+	save_pages('harvest.json', pages)
@@ -1,9 +1,16 @@
 #!/usr/bin/python2
 
-import cStringIO, getopt, urllib2, re, sys
+import cStringIO, getopt, json, random, socket, urllib2, sys, threading, time, Queue
+from collections import OrderedDict
 from os import system
-from services import service, get_brightcove_streams, build_brightcove_dict
+from services import get_brightcove_streams, build_brightcove_dict
+from dispatch import candidates, step_matches, BudgetExceeded
+from cache import cache_key
+from health import HealthTracker
+from connpool import pool, split_timeout, PooledHTTPHandler, PooledHTTPSHandler
 from kanal5 import get_kanal5
+from streams import Stream, parse_policy
+from tracing import Span, JsonLinesExporter
 from httplib import BadStatusLine
 
 def del_nones(dict):
@@ -12,14 +19,25 @@ def del_nones(dict):
 			del dict[item[0]]
 	return dict
 
+def stream_identity(item):
+	if isinstance(item, Stream):
+		return item.identity()
+	return item
+
+def unique(items, key = stream_identity):
+	# Yields each distinct item as soon as it is produced, in resolver order.
+	seen = set()
+	for item in items:
+		identity = key(item)
+		if identity not in seen:
+			seen.add(identity)
+			yield item
+
 def remove_duplicates(cmds):
-	dict = {}
-	for cmd in cmds:
-		dict[cmd] = 1
-	return dict.keys()
+	return list(unique(cmds))
 
 def convert_rtmpdump(rtmpdump_cmd, convert):
-	meta, cmd = rtmpdump_cmd.split('\n')
+	meta, newline, cmd = rtmpdump_cmd.rpartition('\n')
 	# Do we realy want to convert?
 	if convert and cmd.startswith('rtmpdump'):
 		args = cmd[9:].split() # Strip 'rtmpdump ' and split
@@ -43,66 +61,493 @@ def convert_rtmpdump(rtmpdump_cmd, convert):
 
 class redirect_handler(urllib2.HTTPRedirectHandler):
 	def http_error_302(self, req, fp, code, msg, headers):
+		fp.close()
 		return cStringIO.StringIO(str(headers))
 
-def generate_getcmd(url, librtmp = False, **args):
-	yielded = False
- 	#urllib2.install_opener(urllib2.build_opener(urllib2.HTTPHandler(debuglevel=1)))
-	urllib2.install_opener(urllib2.build_opener(redirect_handler()))
-	for channel_service in service:
-		match_vars = {'sub' : ''}
-		match_vars.update(args)
-		content = url
-		for item in channel_service:
-			next_re = item['re'] % match_vars
-			for match in re.finditer(next_re, content, re.DOTALL):
-				match_vars.update(del_nones(match.groupdict()))
+#opener = urllib2.build_opener(urllib2.HTTPHandler(debuglevel=1))
+opener = urllib2.build_opener(redirect_handler(), PooledHTTPHandler(pool), PooledHTTPSHandler(pool))
+
+# Pseudo-schemes resolved by a backend function instead of over HTTP.
+schemes = OrderedDict([
+	('kanal5://', get_kanal5),
+	('brightcove:', lambda params: get_brightcove_streams(**build_brightcove_dict(params)))])
+
+# A cache.ResponseCache (or None) consulted before every fetch.
+response_cache = None
+
+def set_cache(cache):
+	global response_cache
+	response_cache = cache
+
+# A callable receiving a trace.Span for every chain step, or None.
+tracer = None
+
+def set_tracer(callback):
+	global tracer
+	tracer = callback
+
+# A health.HealthTracker (or None) deciding which chains are worth trying.
+# Off unless set, since a breaker tripped by other URLs only makes sense
+# in a long run over many of them (--batch, --serve).
+health = None
+
+def set_health(tracker):
+	global health
+	health = tracker
+
+# Timeouts for resolver fetches as (connect, read) seconds, overridden per
+# step by a 'timeout' entry.  GETs failing with a connection error, a
+# timeout or a 5xx are retried up to fetch_retries times (or the step's
+# 'retries'), after a random pause of up to retry_backoff * 2**attempt.
+fetch_timeout = (5, 15)
+fetch_retries = 2
+retry_backoff = 0.25
+
+def expires_at(deadline):
+	return None if deadline is None else time.time() + deadline
+
+def expired(state):
+	until = state.get('deadline')
+	if until is not None and time.time() >= until:
+		state['expired'] = True
+		return True
+	return False
+
+def halted(state):
+	# The deadline has passed, or the consumer already has what it wanted.
+	stop = state.get('stop')
+	if stop is not None and stop.is_set():
+		state['stopped'] = True
+		return True
+	return expired(state)
+
+def step_timeout(item, until):
+	connect, read = split_timeout(item.get('timeout', fetch_timeout))
+	if until is not None:
+		left = max(until - time.time(), 0.001)
+		connect, read = min(connect, left), min(read, left)
+	return (connect, read)
+
+def transient(err):
+	# Connection errors, timeouts and 5xx responses say something about the
+	# service; anything else (a 404 for a removed episode, an unknown URL
+	# type) only about the URL.
+	if isinstance(err, urllib2.HTTPError):
+		return err.code >= 500
+	if isinstance(err, urllib2.URLError):
+		return isinstance(err.reason, socket.error)
+	return isinstance(err, socket.error)
+
+def retry_delay(req, err, attempt, item, until):
+	# Seconds to wait before retrying a failed request, or None to give up.
+	if req.has_data() or attempt >= item.get('retries', fetch_retries) or not transient(err):
+		return None
+	delay = random.uniform(0, retry_backoff * 2 ** attempt)
+	if until is not None and time.time() + delay >= until:
+		return None
+	return delay
+
+def open_request(req, item, until):
+	attempt = 0
+	while True:
+		try:
+			return opener.open(req, None, step_timeout(item, until))
+		except (urllib2.URLError, socket.error) as err:
+			delay = retry_delay(req, err, attempt, item, until)
+			if delay is None:
+				raise
+			if isinstance(err, urllib2.HTTPError):
+				# Gives the connection back before the pause.
+				err.close()
+			time.sleep(delay)
+			attempt += 1
+
+class StreamedResponse(object):
+	# A response fetch() leaves unread for a streamed step to match against
+	# as it arrives (see dispatch.stream_matches).
+	def __init__(self, response):
+		self.response = response
+		self.bytes = 0
+	def read(self, size = -1):
+		try:
+			data = self.response.read(size) if size >= 0 else self.response.read()
+		except socket.error:
+			# A stalled body ends the stream; whatever matched so far stands.
+			return ''
+		self.bytes += len(data)
+		return data
+	def abort(self):
+		getattr(self.response.fp, 'abort', self.response.close)()
+	def close(self):
+		self.response.close()
+
+def failed(state, err):
+	# The URL of a failed fetch is still yielded as a command, so count the
+	# failures to tell them from commands the chain really produced.
+	state['error'] = repr(err)
+	state['failed'] = state.get('failed', 0) + 1
+	if transient(err):
+		state['broken'] = repr(err)
+
+def fetch(item, next_url, match_vars, name = None, span = None, stream = False, state = None):
+	req = urllib2.Request(next_url)
+	
+	if 'post-template' in item:
+		req.add_data(item['post-template'] % match_vars)
+	
+	for header, value in item.get('headers', {}).items():
+		req.add_header(header, value)
+	
+	cache = response_cache
+	if cache is not None:
+		key = cache_key(next_url, req.get_data(), req.headers)
+		content = cache.get(key)
+		if content is not None:
+			if span is not None:
+				span.cached += 1
+			return content
+	
+	started = time.time()
+	for prefix, backend in schemes.items():
+		if next_url.startswith(prefix):
+			content = backend(next_url[len(prefix):]).encode('ascii')
+			break
+	else:
+		try:
+			response = open_request(req, item, state.get('deadline') if state is not None else None)
+		except urllib2.HTTPError as err:
+			err.close()
+			if span is not None:
+				span.status = err.code
+			if state is not None:
+				failed(state, err)
+			return None
+		except (urllib2.URLError, socket.error) as err:
+			if state is not None:
+				failed(state, err)
+			return None
+		except ValueError:
+			return None
+		if span is not None:
+			span.status = getattr(response, 'code', None)
+		if stream and getattr(response, 'code', None) == 200:
+			if span is not None:
+				span.fetches += 1
+				span.fetch_time += time.time() - started
+			return StreamedResponse(response)
+		try:
+			content = response.read()
+		except socket.error as err:
+			response.close()
+			if state is not None:
+				failed(state, err)
+			return None
+		response.close()
+	if span is not None:
+		span.fetches += 1
+		span.bytes += len(content)
+		span.fetch_time += time.time() - started
+	
+	if cache is not None:
+		cache.put(key, content, name)
+	return content
+
+def run_steps(name, steps, url, content, match_vars, state, first_step = 0):
+	trace = tracer
+	for index, item in enumerate(steps):
+		if halted(state):
+			return
+		span = None
+		source = content
+		stream = index + 1 < len(steps) and 'stream' in steps[index + 1]
+		matches = step_matches(item, match_vars, content)
+		if trace is not None:
+			span = Span(url, name, first_step + index, item['template'])
+			matches = span.timed(matches)
+		try:
+			for groups in matches:
+				if halted(state):
+					return
+				state['entered'] = True
+				match_vars.update(del_nones(groups))
 				
 				next_url = item['template'] % match_vars
 				next_url = item.get('decode', lambda (url): url)(next_url)
-				req = urllib2.Request(next_url)
-				
-				if 'post-template' in item:
-					req.add_data(item['post-template'] % match_vars)
-				
-				for header, value in item.get('headers', {}).items():
-					req.add_header(header, value)
 				
-				try:
-					response = urllib2.urlopen(req)
-					content = response.read()
-					response.close()
-				except urllib2.URLError: #Kanal5
-					if next_url.startswith('kanal5://'):
-						content = get_kanal5(next_url[9:]).encode('ascii')
-					elif next_url.startswith('brightcove:'):
-						brightcove_params = build_brightcove_dict(next_url[11:])
-						content = get_brightcove_streams(**brightcove_params).encode('ascii')
-					else:
-						yielded = True
-						yield convert_rtmpdump(next_url, librtmp)
-				except ValueError:
-					yielded = True
-					yield convert_rtmpdump(next_url, librtmp)
-				except BadStatusLine as excp:
-					yielded = True
+				fetched = fetch(item, next_url, match_vars, name, span, stream, state)
+				if fetched is None:
+					state['yielded'] = True
+					yield next_url
+				else:
+					if content is not source and isinstance(content, StreamedResponse):
+						content.abort()
+					content = fetched
+		except BadStatusLine as err:
+			state['yielded'] = True
+			if span is not None:
+				span.error = repr(err)
+			continue
+		except BudgetExceeded as err:
+			if span is not None:
+				span.error = repr(err)
+			return
+		except Exception as err:
+			if span is not None:
+				span.error = repr(err)
+			raise
+		finally:
+			if span is not None:
+				if isinstance(source, StreamedResponse):
+					span.bytes += source.bytes
+				trace(span)
+		if content == url:
+			return
+	state['content'] = content
+	state['complete'] = True
+
+def checked(name, url, cmds, state):
+	# Passes a chain's commands through and tells the health tracker how
+	# the chain did, unless the consumer stopped before it finished.
+	monitor = health
+	produced = 0
+	for cmd in cmds:
+		produced += 1
+		yield cmd
+	if monitor is None:
+		return
+	if produced > state.get('failed', 0):
+		monitor.success(name, url)
+	elif state.get('expired') or state.get('stopped'):
+		# Cut short by the deadline or the consumer, which says nothing
+		# about the chain.
+		return
+	elif 'broken' in state:
+		monitor.failure(name, state['broken'])
+	elif state.get('entered') or 'error' in state:
+		monitor.empty(name, url)
+
+def allowed(name, url):
+	return health is None or health.allow(name, url)
+
+def initial_vars(args):
+	match_vars = {'sub' : ''}
+	match_vars.update(args)
+	return match_vars
+
+def step_key(item):
+	return (item['re'], item.get('extract'), item['template'], item.get('post-template'),
+		tuple(sorted(item.get('headers', {}).items())), item.get('decode'))
+
+def spawn(target, *args):
+	thread = threading.Thread(target=target, args=args)
+	thread.daemon = True
+	thread.start()
+	return thread
+
+def feed_queue(queue, cmds):
+	try:
+		for cmd in cmds:
+			queue.put(('cmd', cmd))
+	except Exception:
+		queue.put(('error', sys.exc_info()))
+	queue.put(('done', None))
+
+def run_group(group, url, args, queues, until = None, stop = None):
+	# All chains in a group share their first step, so it is fetched once
+	# and the remaining steps of every chain run against the same response.
+	# Setting stop makes every chain give up before its next fetch.
+	state = {'deadline': until, 'stop': stop}
+	match_vars = initial_vars(args)
+	first_queue = queues[group[0][0]]
+	try:
+		for cmd in run_steps(group[0][0], group[0][1][:1], url, url, match_vars, state):
+			first_queue.put(('cmd', cmd))
+	except Exception:
+		first_queue.put(('error', sys.exc_info()))
+		state = {}
+	for name, steps in group:
+		if state.get('complete'):
+			chain_state = {'entered': True, 'deadline': until, 'stop': stop}
+			cmds = run_steps(name, steps[1:], url, state['content'], dict(match_vars), chain_state, 1)
+			spawn(feed_queue, queues[name], checked(name, url, cmds, chain_state))
+		else:
+			if health is not None and 'broken' in state:
+				health.failure(name, state['broken'])
+			elif health is not None and 'error' in state:
+				health.empty(name, url)
+			queues[name].put(('done', None))
+
+def generate_all(url, args, until = None):
+	chains = [(name, steps) for name, steps in candidates(url) if allowed(name, url)]
+	groups = OrderedDict()
+	for name, steps in chains:
+		groups.setdefault(step_key(steps[0]), []).append((name, steps))
+	queues = dict((name, Queue.Queue()) for name, steps in chains)
+	stop = threading.Event()
+	for group in groups.values():
+		spawn(run_group, group, url, args, queues, until, stop)
+	try:
+		for name, steps in chains:
+			while True:
+				kind, value = queues[name].get()
+				if kind == 'done':
 					break
-			else:
-				if content == url:
+				elif kind == 'error':
+					raise value[0], value[1], value[2]
+				yield name, value
+	finally:
+		# Closed early (a policy was satisfied) or done: the chain threads
+		# stop fetching.
+		stop.set()
+
+def resolve_raw(url, fanout, args, selector = None, until = None):
+	if fanout:
+		for name, cmd in generate_all(url, args, until):
+			yield name, cmd
+		return
+	state = {'deadline': until}
+	for name, channel_service in candidates(url):
+		if expired(state):
+			break
+		if not allowed(name, url):
+			continue
+		state['complete'] = False
+		for key in ('error', 'broken', 'failed', 'entered'):
+			state.pop(key, None)
+		cmds = run_steps(name, channel_service, url, url, initial_vars(args), state)
+		for cmd in checked(name, url, cmds, state):
+			yield name, cmd
+		if selector is not None:
+			if selector.chain_done():
+				break
+		elif state['complete'] and state.get('yielded'):
+			break
+
+def resolve(url, librtmp = False, fanout = False, deadline = None, **args):
+	# Like generate_getcmd, but yields (service name, cmd) pairs.
+	for name, cmd in resolve_raw(url, fanout, args, until = expires_at(deadline)):
+		yield name, convert_rtmpdump(cmd, librtmp)
+
+def generate_streams(url, fanout = False, deadline = None, **args):
+	for name, cmd in resolve_raw(url, fanout, args, until = expires_at(deadline)):
+		yield Stream(cmd, name)
+
+def select_stream(url, policy, fanout = False, deadline = None, **args):
+	# Returns the policy's selector once it is satisfied or the
+	# candidate chains are exhausted; its best attribute is the choice.
+	selector = policy.start()
+	cmds = resolve_raw(url, fanout, args, selector, expires_at(deadline))
+	try:
+		for name, cmd in cmds:
+			if selector.offer(Stream(cmd, name)):
+				break
+	finally:
+		cmds.close()
+	return selector
+
+def generate_getcmd(url, librtmp = False, fanout = False, policy = None, deadline = None, **args):
+	# With a deadline (in seconds) the resolve stops fetching once it has
+	# passed, and only the commands found by then are produced.
+	if policy is not None:
+		best = select_stream(url, policy, fanout, deadline, **args).best
+		if best is not None:
+			yield convert_rtmpdump(str(best), librtmp)
+		return
+	for name, cmd in resolve(url, librtmp, fanout, deadline, **args):
+		yield cmd
+
+def resolve_record(url, fanout = False, policy = None, deadline = None, **args):
+	result = {'url': url, 'streams': [], 'error': None}
+	started = time.time()
+	try:
+		if policy is None:
+			result['streams'] = list(generate_streams(url, fanout, deadline, **args))
+		else:
+			best = select_stream(url, policy, fanout, deadline, **args).best
+			result['streams'] = [best] if best is not None else []
+	except Exception:
+		result['error'] = sys.exc_info()
+	result['elapsed'] = time.time() - started
+	return result
+
+def imap_unordered(func, items, concurrency):
+	# Applies func to items on a bounded pool of worker threads and yields
+	# the results in completion order.  An exception raised by func (or by
+	# items) is raised again here, and no further items are started.
+	items = iter(items)
+	lock = threading.Lock()
+	results = Queue.Queue()
+	stopped = threading.Event()
+	done = object()
+	def worker():
+		try:
+			while not stopped.is_set():
+				with lock:
+					item = next(items, done)
+				if item is done:
 					break
+				results.put(('result', func(item)))
+		except Exception:
+			stopped.set()
+			results.put(('error', sys.exc_info()))
+		results.put(('done', None))
+	for i in range(concurrency):
+		spawn(worker)
+	running = concurrency
+	while running:
+		kind, value = results.get()
+		if kind == 'done':
+			running -= 1
+		elif kind == 'error':
+			raise value[0], value[1], value[2]
 		else:
-			if yielded: break
+			yield value
+
+def resolve_many(urls, concurrency = 8, fanout = False, policy = None, deadline = None, **args):
+	# Yields one resolve_record() dict per url, in completion order.
+	return imap_unordered(lambda url: resolve_record(url, fanout, policy, deadline, **args), urls, concurrency)
 
+def batch_record(result):
+	streams = []
+	for stream in result['streams']:
+		record = {'service': stream.service,
+			'protocol': stream.protocol,
+			'cmd': stream.ffplay(),
+			'bitrate': stream.bitrate,
+			'resolution': stream.resolution,
+			'quality': stream.quality,
+			'subtitles': stream.subtitles}
+		if record not in streams:
+			streams.append(record)
+	error = result['error']
+	return {'url': result['url'],
+		'service': streams[0]['service'] if streams else None,
+		'streams': streams,
+		'bitrates': sorted(set(stream['bitrate'] for stream in streams if stream['bitrate'] is not None)),
+		'subtitles': sorted(set(stream['subtitles'] for stream in streams if stream['subtitles'])),
+		'elapsed': round(result['elapsed'], 3),
+		'error': None if error is None else '%s: %s' % (error[0].__name__, error[1])}
+
+def run_batch(infile, workers, fanout, policy = None, deadline = None):
+	urls = (line.strip() for line in infile)
+	urls = (url for url in urls if url and not url.startswith('#'))
+	for result in resolve_many(urls, workers, fanout, policy, deadline, output_file = '-'):
+		sys.stdout.write(json.dumps(batch_record(result)) + '\n')
+		sys.stdout.flush()
 
 class Modes:
 	Print, Play, Save = range(3)
 
 if __name__ == "__main__":
-	if system('which ffplay > /dev/null') != 0:
-		sys.exit('\nffplay not found.\nPirateplay needs ffplay to play your streams.')
-	
-	opts, values = getopt.getopt(sys.argv[1:], 'pys:', ['print', 'play', 'save='])
+	opts, values = getopt.getopt(sys.argv[1:], 'pys:ab:w:S:', ['print', 'play', 'save=', 'all', 'batch=', 'workers=', 'serve=', 'select=', 'trace=', 'deadline='])
 	mode = Modes.Play
+	fanout = False
+	batch = None
+	serve_address = None
+	policy = None
+	select = None
+	workers = 8
+	deadline = None
 	for option, value in opts:
 			if option == '--print' or option == '-p':
 				mode = Modes.Print
@@ -110,15 +555,49 @@ if __name__ == "__main__":
 				mode = Modes.Play
 			elif option == '--save' or option == '-s':
 				mode = Modes.Save
+			elif option == '--all' or option == '-a':
+				fanout = True
+			elif option == '--batch' or option == '-b':
+				batch = value
+			elif option == '--workers' or option == '-w':
+				workers = int(value)
+			elif option == '--serve':
+				serve_address = value
+			elif option == '--select' or option == '-S':
+				policy = parse_policy(value)
+				select = value
+			elif option == '--trace':
+				set_tracer(JsonLinesExporter(value))
+			elif option == '--deadline':
+				deadline = float(value)
+	
+	if serve_address is not None:
+		import server
+		server.serve(serve_address, workers, select, deadline)
+		sys.exit()
+	
+	if batch is not None:
+		set_health(HealthTracker())
+		run_batch(sys.stdin if batch == '-' else open(batch), workers, fanout, policy, deadline)
+		sys.exit()
+	
+	if system('which ffplay > /dev/null') != 0:
+		sys.exit('\nffplay not found.\nPirateplay needs ffplay to play your streams.')
+	
 	i = 0
 	exe = []
-	for cmd in remove_duplicates(generate_getcmd(sys.argv[len(sys.argv)-1], True, output_file="-")):
+	url = sys.argv[len(sys.argv)-1]
+	if policy is None:
+		found = generate_streams(url, fanout, deadline, output_file="-")
+	else:
+		found = filter(None, [select_stream(url, policy, fanout, deadline, output_file="-").best])
+	for stream in unique(found):
 		if mode == Modes.Print:
-			print cmd
+			print stream.render(True)
 		else:
-			exe.append(None)
-			desc, exe[i] = cmd.splitlines()
+			exe.append(stream.ffplay())
 			i += 1
+			desc = stream.meta
 			if desc == '#':
 				desc = '#Stream %d' % i
 			print('%d. %s' % (i, desc.strip('#')))
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# Download scheduling for svtfetcher.
+#
+# DownloadScheduler runs queued jobs on a fixed number of workers, at
+# most per_host of them against the same CDN host, highest priority
+# (lowest number) first.  A job that fails is put back in the queue and
+# retried, resuming what it already has, after a growing delay.  A
+# Shaper shared by all transfers keeps their total rate under a cap by
+# pausing (SIGSTOP) a downloader process whenever it gets ahead, which
+# TCP then passes on to the server.
+#
+# A job is any object with priority, host and label attributes and an
+# execute(transfer, attempt) method returning True on success, where
+# transfer(argv, path) runs one download command and returns its exit
+# status, and transfer.fetch(url, path, tmppath) downloads a plain HTTP
+# file in-process with httpget, shaped by the same Shaper.
+
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+import httpget
+
+RTMPDUMP_PROGRESS = re.compile(r"([\d.]+) kB / ([\d.]+) sec(?: \(([\d.]+)%\))?")
+FFMPEG_PROGRESS = re.compile(r"size=\s*(\d+)kB\s+time=(\d+):(\d+):([\d.]+)")
+FFMPEG_DURATION = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+
+POLL_INTERVAL = 0.5
+REPORT_INTERVAL = 10
+
+output_lock = threading.Lock()
+
+def say(line):
+    with output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+class Shaper(object):
+    # Token bucket over bytes written by all transfers.
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.__tokens = self.burst
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def delay(self, nbytes):
+        # Charges nbytes and returns how long the caller should pause.
+        if not self.rate:
+            return 0
+        with self.__lock:
+            now = time.time()
+            self.__tokens = min(self.burst,
+                                self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            self.__tokens -= nbytes
+            if self.__tokens >= 0:
+                return 0
+            return -self.__tokens / float(self.rate)
+
+class Transfer(object):
+    # One run of a download command, watched for progress.
+    def __init__(self, label, shaper=None):
+        self.label = label
+        self.shaper = shaper
+        self.percent = None
+        self.kbytes = 0
+        self.duration = None
+
+    def parse(self, line):
+        match = RTMPDUMP_PROGRESS.search(line)
+        if match is not None:
+            self.kbytes = float(match.group(1))
+            if match.group(3) is not None:
+                self.percent = float(match.group(3))
+            return
+        match = FFMPEG_DURATION.search(line)
+        if match is not None:
+            self.duration = seconds(*match.groups())
+        match = FFMPEG_PROGRESS.search(line)
+        if match is not None:
+            self.kbytes = float(match.group(1))
+            if self.duration:
+                self.percent = min(100.0, 100 * seconds(*match.groups()[1:]) /
+                                   self.duration)
+
+    def read_progress(self, stream):
+        # Both tools redraw their progress line with \r.
+        line = ""
+        while True:
+            chunk = stream.read(256)
+            if not chunk:
+                return
+            for char in chunk:
+                if char in "\r\n":
+                    self.parse(line)
+                    line = ""
+                else:
+                    line += char
+
+    def report(self):
+        if self.percent is not None:
+            say("[%5.1f%%] %s (%d kB)" % (self.percent, self.label, self.kbytes))
+        else:
+            say("[ ---- ] %s (%d kB)" % (self.label, self.kbytes))
+
+    def __call__(self, argv, path):
+        devnull = open(os.devnull, "w")
+        try:
+            process = subprocess.Popen(argv, stdout=devnull,
+                                       stderr=subprocess.PIPE)
+        except OSError as err:
+            say("Cannot run %s: %s" % (argv[0], err))
+            devnull.close()
+            return -1
+        reader = threading.Thread(target=self.read_progress,
+                                  args=(process.stderr,))
+        reader.daemon = True
+        reader.start()
+        size = file_size(path)
+        reported = time.time()
+        while process.poll() is None:
+            time.sleep(POLL_INTERVAL)
+            if self.shaper is not None:
+                new_size = file_size(path)
+                pause = self.shaper.delay(max(0, new_size - size))
+                size = new_size
+                if pause > 0 and process.poll() is None:
+                    os.kill(process.pid, signal.SIGSTOP)
+                    time.sleep(pause)
+                    os.kill(process.pid, signal.SIGCONT)
+            if time.time() - reported >= REPORT_INTERVAL:
+                self.report()
+                reported = time.time()
+        reader.join(1)
+        devnull.close()
+        return process.returncode
+
+    def fetch(self, url, path, tmppath):
+        # Returns True once path is complete.
+        reported = [time.time()]
+
+        def progress(done, total):
+            self.kbytes = done / 1024.0
+            if total:
+                self.percent = 100.0 * done / total
+            if time.time() - reported[0] >= REPORT_INTERVAL:
+                self.report()
+                reported[0] = time.time()
+
+        throttle = self.shaper.delay if self.shaper is not None else None
+        try:
+            httpget.download(url, path, tmppath, progress=progress,
+                             throttle=throttle)
+        except (httpget.DownloadError, urllib2.URLError, socket.error,
+                IOError) as err:
+            say("Download of %s stopped: %s" % (self.label, err))
+            return False
+        return True
+
+def seconds(hours, minutes, secs):
+    return int(hours) * 3600 + int(minutes) * 60 + float(secs)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class DownloadScheduler(object):
+    def __init__(self, workers=2, per_host=1, host_limits=None,
+                 bandwidth=None, retries=3, retry_delay=30):
+        self.per_host = per_host
+        self.host_limits = host_limits or {}
+        self.shaper = Shaper(bandwidth) if bandwidth else None
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.completed = 0
+        self.failed = []
+        self.__queue = []
+        self.__seq = 0
+        self.__active = {}
+        self.__running = 0
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.__workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+
+    def add(self, job, attempt=0, not_before=0):
+        with self.__cond:
+            self.__seq += 1
+            self.__queue.append((job.priority, self.__seq, not_before, attempt,
+                                 job))
+            self.__cond.notify_all()
+
+    def close(self):
+        # No more jobs will be added; waits for the queue to drain.
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        for worker in self.__workers:
+            while worker.is_alive():
+                worker.join(1)
+
+    def limit(self, host):
+        return self.host_limits.get(host, self.per_host)
+
+    def __take(self):
+        with self.__cond:
+            while True:
+                now = time.time()
+                wait = 1
+                for entry in sorted(self.__queue):
+                    priority, seq, not_before, attempt, job = entry
+                    if not_before > now:
+                        wait = min(wait, not_before - now)
+                    elif self.__active.get(job.host, 0) < self.limit(job.host):
+                        self.__queue.remove(entry)
+                        self.__active[job.host] = self.__active.get(job.host, 0) + 1
+                        self.__running += 1
+                        return job, attempt
+                if self.__closed and not self.__queue and not self.__running:
+                    self.__cond.notify_all()
+                    return None, None
+                self.__cond.wait(wait)
+
+    def __done(self, job, ok, retried):
+        with self.__cond:
+            self.__active[job.host] -= 1
+            self.__running -= 1
+            if ok:
+                self.completed += 1
+            elif not retried:
+                self.failed.append(job)
+            self.__cond.notify_all()
+
+    def __work(self):
+        while True:
+            job, attempt = self.__take()
+            if job is None:
+                return
+            try:
+                ok = job.execute(Transfer(job.label, self.shaper), attempt)
+            except Exception as err:
+                say("Download of %s failed: %s" % (job.label, err))
+                ok = False
+            if not ok and attempt < self.retries:
+                delay = self.retry_delay * 2 ** attempt
+                say("Retrying %s in %d seconds" % (job.label, delay))
+                self.add(job, attempt + 1, time.time() + delay)
+            elif not ok:
+                say("Giving up on %s" % job.label)
+            self.__done(job, ok, attempt < self.retries)
@@ -0,0 +1,144 @@
+import BaseHTTPServer, json, SocketServer, threading, urlparse
+import pirateplay
+from cache import MemoryCache
+from health import HealthTracker
+from connpool import pool
+from streams import parse_policy
+
+# HTTP front-end for the resolver, run with pirateplay.py --serve :8080.
+#
+#   GET  /resolve?url=...[&all=1]   one batch record as JSON
+#   POST /resolve[?all=1]           a JSON list of urls, answered with a
+#                                   JSON list of records in the same order
+#   GET  /stats                     connection pool, cache, chain health and
+#                                   server counters
+#
+# Both kinds of /resolve also take select=POLICY and deadline=SECONDS, as
+# --select and --deadline on the command line, whose values (given with
+# --serve) are the defaults.
+
+class Coalescer(object):
+	# Concurrent calls with the same arguments share a single evaluation.
+	def __init__(self, func):
+		self.func = func
+		self.calls = 0
+		self.coalesced = 0
+		self._pending = {}
+		self._lock = threading.Lock()
+	def __call__(self, *key):
+		with self._lock:
+			self.calls += 1
+			call = self._pending.get(key)
+			leader = call is None
+			if leader:
+				call = self._pending[key] = {'done': threading.Event()}
+			else:
+				self.coalesced += 1
+		if not leader:
+			call['done'].wait()
+			if 'result' in call:
+				return call['result']
+			return self.func(*key)
+		try:
+			call['result'] = self.func(*key)
+			return call['result']
+		finally:
+			with self._lock:
+				del self._pending[key]
+			call['done'].set()
+
+class ResolveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+	wbufsize = -1
+	def send_json(self, code, data):
+		body = json.dumps(data)
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	def parse_path(self):
+		path, _, query = self.path.partition('?')
+		query = urlparse.parse_qs(query, True)
+		return path, query, query.get('all', ['0'])[0] not in ('0', '')
+	def parse_options(self, query):
+		# (select, deadline) from the query, or the server's defaults.
+		select = query.get('select', [self.server.select])[0] or None
+		deadline = query.get('deadline', [self.server.deadline])[0]
+		if select is not None:
+			parse_policy(select)
+		if deadline is not None:
+			deadline = float(deadline)
+			if deadline <= 0:
+				raise ValueError('deadline must be positive')
+		return select, deadline
+	def do_GET(self):
+		path, query, fanout = self.parse_path()
+		if path == '/resolve':
+			if 'url' not in query:
+				return self.send_json(400, {'error': 'missing url parameter'})
+			try:
+				select, deadline = self.parse_options(query)
+			except ValueError as err:
+				return self.send_json(400, {'error': str(err)})
+			self.send_json(200, self.server.resolve_url(query['url'][0], fanout, select, deadline))
+		elif path == '/stats':
+			self.send_json(200, self.server.stats())
+		else:
+			self.send_json(404, {'error': 'not found'})
+	def do_POST(self):
+		path, query, fanout = self.parse_path()
+		if path != '/resolve':
+			return self.send_json(404, {'error': 'not found'})
+		try:
+			select, deadline = self.parse_options(query)
+			urls = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			if not isinstance(urls, list):
+				raise ValueError('expected a list of urls')
+		except ValueError as err:
+			return self.send_json(400, {'error': str(err)})
+		records = sorted(pirateplay.imap_unordered(
+			lambda (i, url): (i, self.server.resolve_url(url, fanout, select, deadline)),
+			enumerate(urls), self.server.concurrency))
+		self.send_json(200, [record for i, record in records])
+	def log_message(self, format, *args):
+		pass
+
+class ResolveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	def __init__(self, address, concurrency = 8, resolver = pirateplay.resolve_record, select = None, deadline = None):
+		BaseHTTPServer.HTTPServer.__init__(self, address, ResolveHandler)
+		self.concurrency = concurrency
+		self.select = select
+		self.deadline = deadline
+		# Keyed on the policy's spec, so equal requests coalesce.
+		self.resolver = Coalescer(lambda url, fanout, select, deadline: pirateplay.batch_record(
+			resolver(url, fanout, parse_policy(select) if select else None, deadline, output_file = '-')))
+	def resolve_url(self, url, fanout = False, select = None, deadline = None):
+		return self.resolver(url, fanout, select, deadline)
+	def stats(self):
+		cache = pirateplay.response_cache
+		health = pirateplay.health
+		return {'pool': pool.stats(),
+			'cache': None if cache is None else {'entries': len(cache), 'hits': cache.hits, 'misses': cache.misses},
+			'health': None if health is None else health.stats(),
+			'requests': self.resolver.calls,
+			'coalesced': self.resolver.coalesced}
+
+def parse_address(address):
+	host, _, port = address.rpartition(':')
+	return host, int(port)
+
+def serve(address, concurrency = 8, select = None, deadline = None):
+	if pirateplay.response_cache is None:
+		pirateplay.set_cache(MemoryCache(size = 1024))
+	if pirateplay.health is None:
+		pirateplay.set_health(HealthTracker())
+	httpd = ResolveServer(parse_address(address), concurrency, select = select, deadline = deadline)
+	print 'Serving on %s:%d' % httpd.server_address
+	try:
+		httpd.serve_forever()
+	except KeyboardInterrupt:
+		pass
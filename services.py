@@ -1,6 +1,7 @@
 from urllib import unquote
 import re
-import httplib
+from connpool import pool
+from extractors import json_objects, xml_elements
 from pyamf import remoting
 
 def fix_playpath(url):
@@ -36,9 +37,7 @@ def get_brightcove_streams(video_player, player_id, player_key, publisher_id, co
 	)
 	env = str(remoting.encode(env).read())
 
-	conn = httplib.HTTPConnection("c.brightcove.com")
-	conn.request("POST", "/services/messagebroker/amf?playerKey=" + player_key, env, {'content-type': 'application/x-amf'})
-	response = conn.getresponse().read()
+	response = pool.request("POST", "c.brightcove.com", "/services/messagebroker/amf?playerKey=" + player_key, env, {'content-type': 'application/x-amf'}).read()
 	rtmp = ''
 	for rendition in remoting.decode(response).bodies[0][1].body['renditions']:
 		rtmp += '"%sx%s:%s";' % (rendition['frameWidth'], rendition['frameHeight'], rendition['defaultURL'])
@@ -73,14 +72,18 @@ service = [
 			#{	're'		:	r'(?:name="movie" value="(?P<swf_url>[^"]+)".*?)pathflv=(?P<url>rtmpe?://[^&]+)',
 				#'template'	:	'#\nrtmpdump -W "http://svtplay.se%(swf_url)s" -r "%(url)s" -o %(output_file)s'}],
 		[#SVT-play-beta
-			{	're':			r'^(http://)?(www\.)?svtplay\.se/(?P<path>.*)',
+			{	'service-name':		'SVT-play-beta',
+				're':			r'^(http://)?(www\.)?svtplay\.se/(?P<path>.*)',
 				'template':		'http://svtplay.se/%(path)s?type=embed&output=json'},
 			{	're':			r'"url":"(?P<url>rtmp[^"]+)".*?"bitrate":(?P<bitrate>\d+)(?=.*?"subtitleReferences":\[{"url":"(?P<sub>[^"]*))',
+				'extract':		json_objects({'url': 'url', 'bitrate': 'bitrate'}, context = {'sub': 'subtitleReferences.0.url'}, where = {'url': '^rtmp'}),
 				'template':		'#quality: %(bitrate)s; subtitles: %(sub)s;\nrtmpdump -r "%(url)s" --swfVfy "http://www.svtplay.se/public/swf/video/svtplayer-2012.15.swf" -o "%(output_file)s"'}],
 		[#SVT-play-http
-			{	're':			r'^(http://)?(www\.)?svtplay\.se/(?P<path>.*)',
+			{	'service-name':		'SVT-play-http',
+				're':			r'^(http://)?(www\.)?svtplay\.se/(?P<path>.*)',
 				'template':		'http://svtplay.se/%(path)s?type=embed&output=json'},
 			{	're':			r'"url":"(?P<url>http://[^"]+)".*?"bitrate":(?P<bitrate>\d+)(?=.*?"subtitleReferences":\[{"url":"(?P<sub>[^"]*))',
+				'extract':		json_objects({'url': 'url', 'bitrate': 'bitrate'}, context = {'sub': 'subtitleReferences.0.url'}, where = {'url': '^http://'}),
 				'template':		'#quality: %(bitrate)s; subtitles: %(sub)s;\n%(url)s'}],
 		[
 			{	'service-name':		'SR',
@@ -99,24 +102,33 @@ service = [
 				're'		:	r'(http://)?(www\.)?tv4play.se/.*(videoid|vid)=(?P<id>\d+).*',
 				'template'	:	'http://premium.tv4play.se/api/web/asset/%(id)s/play'},
 			{	're'		:	r'(<playbackStatus>(?P<status>\w+).*?)?<bitrate>(?P<bitrate>[0-9]+)</bitrate>.*?(?P<base>rtmpe?://[^<]+).*?(?P<url>mp4:/[^<]+)(?=.*?(?P<sub>http://((anytime)|(prima))\.tv4(play)?\.se/multimedia/vman/smiroot/[^<]+))?',
+				'extract'	:	xml_elements('item', {'bitrate': 'bitrate', 'base': 'base', 'url': 'url'},
+							{'status': 'playbackStatus', 'sub': ('url', r'^http://((anytime)|(prima))\.tv4(play)?\.se/multimedia/vman/smiroot/')},
+							{'base': '^rtmpe?://', 'url': '^mp4:/'}),
 				'template'	:	'#quality: %(bitrate)s kbps; subtitles: %(sub)s;\nrtmpdump -W "http://www.tv4play.se/flash/tv4playflashlets.swf" -r "%(base)s" -y "%(url)s" -o "%(output_file)s"'}],
 		[
 			{	'service-name':		'Fotbollskanalen',
 				're'		:	r'(http://)?(www\.)?fotbollskanalen.se/.*(videoid|vid)=(?P<id>\d+).*',
 				'template'	:	'http://premium.tv4play.se/api/web/asset/%(id)s/play'},
 			{	're'		:	r'(<playbackStatus>(?P<status>\w+).*?)?<bitrate>(?P<bitrate>[0-9]+)</bitrate>.*?(?P<base>rtmpe?://[^<]+).*?(?P<url>mp4:/[^<]+)(?=.*?(?P<sub>http://anytime.tv4.se/multimedia/vman/smiroot/[^<]+))?',
+				'extract'	:	xml_elements('item', {'bitrate': 'bitrate', 'base': 'base', 'url': 'url'},
+							{'status': 'playbackStatus', 'sub': ('url', r'^http://anytime.tv4.se/multimedia/vman/smiroot/')},
+							{'base': '^rtmpe?://', 'url': '^mp4:/'}),
 				'template'	:	'#quality: %(bitrate)s kbps; subtitles: %(sub)s;\nrtmpdump -W "http://www.tv4play.se/flash/tv4playflashlets.swf" -r "%(base)s" -y "%(url)s" -o "%(output_file)s"'}],
 		[
 			{	'service-name':		'MTG',
 				're'		:	r'(http://)?(www\.)?tv[368]play.se/.*(?:play/(?P<id>\d+)).*',
 				'template'	:	'http://viastream.viasat.tv/PlayProduct/%(id)s'},
 			{	're'		:	r'<SamiFile>(?P<sub>[^<]*).*<Video>.*<BitRate>(?P<bitrate>\d+).*?<Url><!\[CDATA\[(?P<url>rtmp[^\]]+)',
+				'extract'	:	xml_elements('Video', {'bitrate': 'BitRate', 'url': 'Url'}, {'sub': 'SamiFile'}, {'url': '^rtmp'}),
 				'template'	:	'#quality: %(bitrate)s kbps; subtitles: %(sub)s;\nrtmpdump -W http://flvplayer.viastream.viasat.tv/play/swf/player120328.swf -r %(url)s -o %(output_file)s',
 				'decode':		fix_playpath}],
 		[#MTG-alternate
-			{	're'		:	r'(http://)?(www\.)?tv[368]play.se/.*(?:play/(?P<id>\d+)).*',
+			{	'service-name':		'MTG-alternate',
+				're'		:	r'(http://)?(www\.)?tv[368]play.se/.*(?:play/(?P<id>\d+)).*',
 				'template'	:	'http://viastream.viasat.tv/PlayProduct/%(id)s'},
 			{	're'		:	r'<SamiFile>(?P<sub>[^<]*).*<Video>.*<BitRate>(?P<bitrate>\d+).*?<Url><!\[CDATA\[(?P<url>http[^\]]+)',
+				'extract'	:	xml_elements('Video', {'bitrate': 'BitRate', 'url': 'Url'}, {'sub': 'SamiFile'}, {'url': '^http'}),
 				'template'	:	'%(url)s'},
 			{	're'		:	r'<Url>(?P<url>[^<]+)',
 				'template'	:	'#quality: %(bitrate)s kbps; subtitles: %(sub)s;\nrtmpdump -W http://flvplayer.viastream.viasat.tv/play/swf/player120328.swf -r %(url)s -o %(output_file)s',
@@ -126,6 +138,7 @@ service = [
 				're'		:	r'(http://)?(www\.)?aftonbladet.se/(?P<url>.+)',
 				'template'	:	'http://aftonbladet.se/%(url)s'},
 			{	're'		:	'videoUrl:\s"(?P<base>rtmp://(ss11i04.stream.ip-only.net|fl1.c00862.cdn.qbrick.com)/[^/]+/)(?P<url>[^"]+)"',
+				'stream'	:	1,
 				'template'	:	'#\nrtmpdump -r "%(base)s" -y "%(url)s" -o "%(output_file)s"'}],
 		[
 			{
@@ -155,6 +168,7 @@ service = [
 				're':			r'(http://)?(www\.)?kanal5play.se/.*video/(?P<id>\d+)',
 				'template':		'http://www.kanal5play.se/api/getVideo?format=FLASH&videoId=%(id)s'},
 			{	're':			r'"bitrate":(?P<bitrate>\d+).*?"source":"(?P<path>[^"]+)"(?=.*?"streamBaseUrl":"(?P<base>[^"]+)")',
+				'extract':		json_objects({'bitrate': 'bitrate', 'path': 'source'}, {'base': 'streamBaseUrl'}, {'base': '.'}),
 				'template':		'#quality: %(bitrate)s\nrtmpdump -r "%(base)s" -y "%(path)s" -W "http://www.kanal5play.se/flash/StandardPlayer.swf" -o "%(output_file)s"'}],
 		[
 			{	'service-name':		'Axess-TV',
@@ -196,9 +210,11 @@ service = [
 				'template':		'http://www.dr.dk/nu/api/programseries/%(title)s/videos'},
 			{
 				're':			r'"id": %(id)s,[^}]+"videoResourceUrl": "(?P<url>[^"]+)"',
+				'extract':		json_objects({'id': 'id', 'url': 'videoResourceUrl'}, where = {'id': '^%(id)s$'}),
 				'template':		'%(url)s'},
 			{
 				're':			r'uri":"(?P<uri>[^"]+)".*?"bitrateKbps":(?P<bitrate>\d+)',
+				'extract':		json_objects({'uri': 'uri', 'bitrate': 'bitrateKbps'}),
 				'template':		'#quality: %(bitrate)s\nrtmpdump -r %(uri)s -W http://www.dr.dk/nu/assets/swf/NetTVPlayer_10.swf -o %(output_file)s',
 				'decode':		lambda url: fix_playpath(url.replace('\\', ''))}],
 		[
@@ -206,6 +222,7 @@ service = [
 				're':			r'(http://)?(www\.)?ceskatelevize\.cz/(?P<url>.+)',
 				'template':		'http://www.ceskatelevize.cz/%(url)s'},
 			{	're':			'IDEC="(?P<identifier>[^"]+)"',
+				'stream':		1,
 				'template':		'http://www.ceskatelevize.cz/ajax/playlistURL.php',
 				'post-template':	'options%%5BuserIP%%5D=85.226.8.253&options%%5BplayerType%%5D=flash&options%%5BplaylistItems%%5D%%5B0%%5D%%5BType%%5D=Ad&options%%5BplaylistItems%%5D%%5B0%%5D%%5BFormat%%5D=MP4_Web&options%%5BplaylistItems%%5D%%5B0%%5D%%5BIdentifier%%5D=AD-46&options%%5BplaylistItems%%5D%%5B0%%5D%%5BTitle%%5D=Reklama%%3A+Adventn%%C3%%AD+kalend%%C3%%A1%%C5%%99&options%%5BplaylistItems%%5D%%5B0%%5D%%5BSkip%%5D%%5BEnable%%5D=true&options%%5BplaylistItems%%5D%%5B0%%5D%%5BSkip%%5D%%5BDelay%%5D=3&options%%5BplaylistItems%%5D%%5B0%%5D%%5BClickThruURL%%5D=' +
 							'http%%3A%%2F%%2Fadvent.ceskatelevize.cz%%2F&options%%5BplaylistItems%%5D%%5B1%%5D%%5BType%%5D=Archive&options%%5BplaylistItems%%5D%%5B1%%5D%%5BFormat%%5D=MP4_Web&options%%5BplaylistItems%%5D%%5B1%%5D%%5BIdentifier%%5D=%(identifier)s&options%%5BplaylistItems%%5D%%5B1%%5D%%5BTitle%%5D=Vypr%%C3%%A1v%%C4%%9Bj&options%%5BplaylistItems%%5D%%5B1%%5D%%5BRegion%%5D=&options%%5BplaylistItems%%5D%%5B1%%5D%%5BSubtitlesUrl%%5D=http%%3A%%2F%%2Fimg7.ceskatelevize.cz%%2Fivysilani%%2Fsubtitles%%2F211%%2F211522161400013%%2Fsubtitles-1.txt&options%%5BplaylistItems%%5D%%5B1%%5D%%5BIndexes%%5D=null&options%%5BpreviewImageURL%%5D=http%%3A%%2F%%2Fimg7.ceskatelevize.cz%%2Fcache%%2F512x288%%2Fivysilani%%2Fepisodes%%2Fphotos%%2Fw512%%2F10195164142%%2F1-62384.jpg'},
@@ -217,7 +234,7 @@ service = [
 				'headers':		{'User-Agent': 'Mozilla/5.0 (X11; Linux i686; rv:5.0) Gecko/20100101 Firefox/5.0'},
 				'decode':		lambda url: url.replace('&amp;', '&')}],
 		[
-			{	#'service-name':		'Expressen-TV',
+			{	'service-name':		'Expressen-TV',
 				're':			r'(http://)?(www\.)?tv\.expressen\.se(?P<url>.+)',
 				'template':		'http://tv.expressen.se/%(url)s?standAlone=true&output=xml'},
 			{	're':			r"<vurl bitrate='(?P<bitrate>\d+)'><!\[CDATA\[(?P<rtmp_url>[^\]]+)",
@@ -232,7 +249,8 @@ service = [
 			{	're':			r'<meta base="(?P<base>[^"]+).*?<ref src="(?P<path>[^"]+)',
 				'template':		'#\nrtmpdump -r "%(base)s" -y mp4:%(path)s -W "http://www-tc.pbs.org/s3/pbs.videoportal-prod.cdn/media/swf/PBSPlayer.swf" -o "%(output_file)s"'}],
 		[
-			{	're':			r'(http://)?((www|video)\.)?.cnbc.com/.*video=(?P<video>\d+).*',
+			{	'service-name':		'CNBC',
+				're':			r'(http://)?((www|video)\.)?.cnbc.com/.*video=(?P<video>\d+).*',
 				'template':		'http://video.cnbc.com/gallery/?video=%(video)s'},
 			{	're':			r',formatLink:\'[^|]+\|(?P<xml_url>[^\']+)',
 				'template':		'%(xml_url)s'},
@@ -0,0 +1,198 @@
+import copy, getopt, re, shlex
+
+# A resolved stream.  The '#meta\ncmd' string produced by a service
+# template is parsed once, here, and the command formats consumers need
+# are rendered from the parsed fields on demand.
+
+meta_field = re.compile(r'(\w+): ([^;\n]*)')
+resolution_re = re.compile(r'^\d+x\d+$')
+
+rtmpdump_options = ('r:o:W:y:a:v', ['rtmp=', 'swfVfy=', 'playpath=', 'app=', 'live', 'resume'])
+
+def parse_meta(meta):
+	return dict(meta_field.findall(meta))
+
+class Stream(object):
+	__slots__ = ('service', 'meta', 'cmd', 'protocol', 'url', 'playpath', 'swf_url', 'app',
+		'live', 'output_file', 'quality', 'bitrate', 'resolution', 'subtitles')
+
+	def __init__(self, cmd, service = None):
+		self.service = service
+		self.meta, newline, self.cmd = cmd.rpartition('\n')
+
+		fields = parse_meta(self.meta)
+		self.quality = fields.get('quality', '').replace('kbps', '').strip() or None
+		self.subtitles = fields.get('subtitles', '').strip() or None
+		self.bitrate = int(self.quality) if self.quality and self.quality.isdigit() else None
+		self.resolution = self.quality if self.quality and resolution_re.match(self.quality) else None
+
+		self.url = self.playpath = self.swf_url = self.app = self.output_file = None
+		self.live = False
+		if self.cmd.startswith('rtmpdump'):
+			self.parse_rtmpdump(self.cmd)
+		else:
+			self.url = self.cmd.strip()
+		self.protocol = self.url.split(':', 1)[0].lower() if self.url and ':' in self.url else None
+
+	def parse_rtmpdump(self, cmd):
+		try:
+			optlist = getopt.getopt(shlex.split(cmd)[1:], *rtmpdump_options)[0]
+		except (ValueError, getopt.GetoptError):
+			return
+		for option, value in optlist:
+			if option == '--rtmp' or option == '-r':
+				self.url = value
+			elif option == '--swfVfy' or option == '-W':
+				self.swf_url = value
+			elif option == '--playpath' or option == '-y':
+				self.playpath = value
+			elif option == '--app' or option == '-a':
+				self.app = value
+			elif option == '--live' or option == '-v':
+				self.live = True
+			elif option == '-o':
+				self.output_file = value
+
+	def key(self):
+		return (self.meta, self.cmd)
+	def identity(self):
+		# Streams that fetch the same media are duplicates even when their
+		# meta lines or option order differ.
+		if self.url is None:
+			return (None, self.cmd.strip())
+		scheme, sep, rest = self.url.partition('://')
+		host, slash, path = rest.partition('/')
+		return (scheme.lower() + sep + host.lower() + slash + path.rstrip('/'),
+			self.playpath, self.app, self.live)
+	def __eq__(self, other):
+		return isinstance(other, Stream) and self.key() == other.key()
+	def __ne__(self, other):
+		return not self == other
+	def __hash__(self):
+		return hash(self.key())
+	def __repr__(self):
+		return '<Stream %s %s %s>' % (self.service, self.quality, self.url)
+	def __str__(self):
+		return self.render()
+
+	def is_rtmp(self):
+		return self.protocol is not None and self.protocol.startswith('rtmp')
+
+	def render(self, librtmp = False):
+		return self.meta + '\n' + (self.librtmp() if librtmp else self.cmd)
+
+	def rtmpdump(self, output_file = None, resume = False):
+		if not self.is_rtmp():
+			return None
+		cmd = 'rtmpdump -r "%s"' % self.url
+		if self.playpath:
+			cmd += ' -y "%s"' % self.playpath
+		if self.app:
+			cmd += ' -a "%s"' % self.app
+		if self.swf_url:
+			cmd += ' -W "%s"' % self.swf_url
+		if self.live:
+			cmd += ' -v'
+		if resume:
+			cmd += ' --resume'
+		output_file = output_file or self.output_file
+		if output_file:
+			cmd += ' -o "%s"' % output_file
+		return cmd
+
+	def librtmp(self):
+		if not self.is_rtmp():
+			return self.cmd
+		rtmp_string = self.url
+		if self.swf_url:
+			rtmp_string += ' swfVfy=1 swfUrl=' + self.swf_url
+		if self.playpath:
+			rtmp_string += ' playpath=' + self.playpath
+		if self.app:
+			rtmp_string += ' app=' + self.app
+		if self.live:
+			rtmp_string += ' live=1'
+		return rtmp_string
+
+	def ffplay(self):
+		return self.librtmp() if self.is_rtmp() else self.url
+
+# Selection policies for pirateplay.select_stream.  A policy is offered
+# streams as the resolver produces them and says when it has seen
+# enough; the resolver then stops fetching further matches and chains.
+# Policy objects are templates: start() returns a fresh selector so one
+# policy can be shared between concurrent resolves.
+
+class Policy(object):
+	def start(self):
+		selector = copy.copy(self)
+		selector.best = None
+		selector.offered = []
+		return selector
+	def offer(self, stream):
+		self.offered.append(stream)
+		if self.best is None or self.better(stream, self.best):
+			self.best = stream
+		return self.satisfied()
+	def better(self, stream, best):
+		return False
+	def satisfied(self):
+		return False
+	def chain_done(self):
+		return self.best is not None
+	def bitrates(self):
+		return sorted(set(stream.bitrate for stream in self.offered if stream.bitrate is not None))
+
+class FirstHit(Policy):
+	def satisfied(self):
+		return self.best is not None
+
+class HighestBitrate(Policy):
+	def __init__(self, ceiling = None):
+		self.ceiling = ceiling
+	def better(self, stream, best):
+		return stream.bitrate > best.bitrate
+	def satisfied(self):
+		return (self.ceiling is not None and self.best.bitrate is not None
+			and self.best.bitrate >= self.ceiling)
+
+class ClosestBitrate(Policy):
+	# Without a tolerance the first chain that yields anything decides, as
+	# usual; with one, further chains are tried until a stream is close
+	# enough.
+	def __init__(self, target, tolerance = None):
+		self.target = target
+		self.tolerance = tolerance
+	def distance(self, stream):
+		if stream.bitrate is None:
+			return float('inf')
+		return abs(stream.bitrate - self.target)
+	def better(self, stream, best):
+		return self.distance(stream) < self.distance(best)
+	def satisfied(self):
+		return self.distance(self.best) <= (self.tolerance or 0)
+	def chain_done(self):
+		if self.tolerance is None:
+			return Policy.chain_done(self)
+		return self.best is not None and self.satisfied()
+
+class PreferHTTP(Policy):
+	def better(self, stream, best):
+		return stream.protocol in ('http', 'https') and best.protocol not in ('http', 'https')
+	def satisfied(self):
+		return self.best is not None and self.best.protocol in ('http', 'https')
+	def chain_done(self):
+		return self.satisfied()
+
+def parse_policy(spec):
+	name, _, arg = spec.partition(':')
+	if name == 'first':
+		return FirstHit()
+	elif name == 'highest':
+		return HighestBitrate(int(arg) if arg else None)
+	elif name == 'closest':
+		target, _, tolerance = arg.partition('/')
+		return ClosestBitrate(int(target), int(tolerance) if tolerance else None)
+	elif name == 'http':
+		return PreferHTTP()
+	raise ValueError('unknown selection policy: %s' % spec)
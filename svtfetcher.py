@@ -22,6 +22,14 @@
 # Shows that are already downloaded will not be downloaded again,
 # unless you have removed them.  Aborted downloads will have the
 # extension ".tmp", and will be resumed if you re-run this program.
+# Plain HTTP streams are fetched in-process in parallel byte ranges and
+# keep their own container; they always resume, from the ".tmp.parts"
+# file that records how far each range got.
+#
+# What has been seen, resolved and downloaded is remembered in
+# $HOME/.svtfetch.db, along with the validators of every page fetched,
+# so later runs make conditional requests and only resolve new
+# episodes.  Remove that file to start over.
 #
 # A sample .svtfetch file might look like this:
 #
@@ -30,18 +38,34 @@
 
 import os
 import re
+import shlex
+import socket
 import sys
 import urllib2
-import multiprocessing
+import urlparse
 
 import BeautifulSoup
 
+import httpget
 import pirateplay
+import scheduler
+import svtsync
+from scheduler import say
+from streams import HighestBitrate
 
 resume = False
-PARALLELISM = 1
+PARALLELISM = 1              # downloads at a time
+PER_HOST = 1                 # downloads at a time from one CDN host
+HOST_LIMITS = {}             # per-host exceptions, {host: downloads}
+BANDWIDTH = None             # total bytes per second, None for no cap
+RETRIES = 3
+CRAWL_WORKERS = 8
+RESOLVE_WORKERS = 4
 
 SHOW_INDEX = "http://www.svtplay.se/alfabetisk"
+FETCH_TIMEOUT = 30
+SYNC_DB = os.path.join(os.getenv("HOME"), ".svtfetch.db")
+STATE = None
 
 def load_series():
     global DIRS, TITLES
@@ -58,146 +82,276 @@ def load_series():
         DIRS[title] = directory.decode("utf-8")
         TITLES.append(title)
 
+def open_state():
+    global STATE
+    STATE = svtsync.SyncState(SYNC_DB)
+
+def mark(url, state, cmd=None):
+    if STATE is not None and url is not None:
+        STATE.mark(url, state, cmd)
+
 class Downloader(object):
-    def __init__(self, exe, d, tmppath, fullpath):
+    def __init__(self, exe, d, tmppath, fullpath, url=None, host=None,
+                 priority=0, http=False):
+        # With http, exe is the URL of a file to fetch natively.
         self.__exe = exe
+        self.__http = http
         self.__d = d
         self.__tmppath = tmppath
         self.__fullpath = fullpath
+        self.__url = url
+        self.host = host
+        self.priority = priority
+        self.label = os.path.basename(fullpath).encode("utf-8")
 
     def __str__(self):
         return unicode(self).encode("utf-8")
 
-    def execute(self):
+    def execute(self, transfer=None, attempt=0):
+        # Returns True once the file is in place.  Retries (attempt > 0)
+        # resume what the previous attempt got.
         if os.path.exists(self.__fullpath.encode("utf-8")):
-            print "Already downloaded", self.__fullpath.encode("utf-8")
-            return
+            say("Already downloaded %s" % self.__fullpath.encode("utf-8"))
+            mark(self.__url, svtsync.DOWNLOADED)
+            return True
         size = None
 
         # Resume does not work if the file is too small.
         try:
             size = os.stat(self.__tmppath.encode("utf-8")).st_size
-            print "Temporary file of size", size, ":", self.__tmppath.encode("utf-8")
+            say("Temporary file of size %d : %s"
+                % (size, self.__tmppath.encode("utf-8")))
         except OSError:
             pass
-        if size is not None and (size < 1048576 or not resume):
-            print "Unlinking", self.__tmppath.encode("utf-8")
+        if (size is not None and not self.__http
+                and (size < 1048576 or not (resume or attempt > 0))):
+            say("Unlinking %s" % self.__tmppath.encode("utf-8"))
             os.unlink(self.__tmppath.encode("utf-8"))
+            size = None
 
-        print "Downloading", self.__fullpath.encode("utf-8")
-        os.system((u"mkdir -p " + self.__d).encode('utf-8'))
-        print "EXE", self.__exe.encode('utf-8')
-        if os.system(self.__exe.encode('utf-8')) == 0:
-            os.system((u"mv " + self.__tmppath + u" " + self.__fullpath)
-                      .encode('utf-8'))
+        say("Downloading %s" % self.__fullpath.encode("utf-8"))
+        try:
+            os.makedirs(self.__d.encode("utf-8"))
+        except OSError:
+            if not os.path.isdir(self.__d.encode("utf-8")):
+                raise
+        if transfer is None:
+            transfer = scheduler.Transfer(self.label)
+        if self.__http:
+            say("GET %s" % self.__exe.encode('utf-8'))
+            if not transfer.fetch(self.__exe.encode('utf-8'),
+                                  self.__fullpath.encode("utf-8"),
+                                  self.__tmppath.encode("utf-8")):
+                return False
+            mark(self.__url, svtsync.DOWNLOADED)
+            return True
+        exe = self.__exe
+        if (size is not None and exe.startswith("rtmpdump")
+                and "--resume" not in exe):
+            exe = exe.replace(" ", " --resume ", 1)
+        say("EXE %s" % exe.encode('utf-8'))
+        if transfer(shlex.split(exe.encode('utf-8')),
+                    self.__tmppath.encode("utf-8")) != 0:
+            return False
+        os.rename(self.__tmppath.encode("utf-8"),
+                  self.__fullpath.encode("utf-8"))
+        mark(self.__url, svtsync.DOWNLOADED)
+        return True
+
+def episode_number(url):
+    # SVT numbers videos in publishing order, so higher is newer.
+    match = re.search(r"/video/(\d+)", url)
+    return int(match.group(1)) if match else 0
 
 def cmdline(series, url, ignore_downloaded, execute):
-    best = 0
+    # Runs on resolver threads, so an episode's lines are said together.
+    lines = []
+    try:
+        return resolve_cmdline(series, url, ignore_downloaded, execute,
+                               lines.append)
+    finally:
+        if lines:
+            say("\n".join(lines))
+
+def resolve_cmdline(series, url, ignore_downloaded, execute, note):
     file = url.split("/")[-1]
     d = DIRS[series]
     fullpath = os.path.join(d, file + ".flv")
     if ignore_downloaded and os.path.exists(fullpath.encode("utf-8")):
+        mark(url, svtsync.DOWNLOADED)
         return None
     tmppath = fullpath + ".tmp"
     if os.path.exists(tmppath.encode("utf-8")):
         if resume:
-            print "Resuming download:", fullpath.encode("utf-8")
+            note("Resuming download: %s" % fullpath.encode("utf-8"))
         else:
-            print "Restarting download:", fullpath.encode("utf-8")
+            note("Restarting download: %s" % fullpath.encode("utf-8"))
     else:
-        print "New download:", fullpath.encode("utf-8")
+        note("New download: %s" % fullpath.encode("utf-8"))
 
-    best_alt = None
-    all_cmds = pirateplay.generate_getcmd("http://www.svtplay.se" + url,
-                                          False, output_file=tmppath)
     try:
-        non_dups = pirateplay.remove_duplicates(all_cmds)
+        selection = pirateplay.select_stream("http://www.svtplay.se" + url,
+                                             HighestBitrate(),
+                                             output_file=tmppath)
     except ValueError:
-        print "Cannot find cmd for", fullpath
+        note("Cannot find cmd for %s" % fullpath.encode("utf-8"))
         return None
-    bitrates = []
-    for alt in non_dups:
-        lines = alt.splitlines()
-        m = re.search("quality: ([0-9]*)", lines[0])
-        if not m:
-            print "SKIPPING", alt
-            continue
-        q = int(m.group(1))
-        bitrates.append(q)
-        if q > best:
-            best = q
-            best_alt = alt
-
-    if not best_alt:
-        print "No bitrate match found for", url
+    best_alt = selection.best
+    bitrates = selection.bitrates()
+
+    if best_alt is None or best_alt.bitrate is None:
+        note("No bitrate match found for %s" % url)
         return None
+    best = best_alt.bitrate
 
-    lines = best_alt.splitlines()
-    exe = lines[1]
-    if resume:
-        exe = exe.replace(" ", " --resume ", 1)
+    http = not best_alt.is_rtmp() and httpget.progressive(best_alt.url)
+    if best_alt.is_rtmp():
+        exe = best_alt.cmd
+        if resume:
+            exe = exe.replace(" ", " --resume ", 1)
+    elif http:
+        exe = best_alt.url
+        ext = os.path.splitext(urlparse.urlparse(best_alt.url).path)[1] or ".mp4"
+        fullpath = os.path.join(d, file + ext.decode("utf-8"))
+        tmppath = fullpath + ".tmp"
+        if ignore_downloaded and os.path.exists(fullpath.encode("utf-8")):
+            mark(url, svtsync.DOWNLOADED)
+            return None
+    else:
+        exe = u'ffmpeg -y -i "%s" -c copy -f flv "%s"' % (best_alt.url, tmppath)
 
-    print "Selecting bitrate", best, "among", ', '.join(map(str,
-                                                            sorted(bitrates)))
+    note("Selecting bitrate %s among %s"
+         % (best, ', '.join(map(str, sorted(bitrates)))))
 
     if execute:
-        return Downloader(exe, d, tmppath, fullpath)
+        mark(url, svtsync.RESOLVED, exe)
+        return Downloader(exe, d, tmppath, fullpath, url,
+                          urlparse.urlparse(best_alt.url).hostname,
+                          -episode_number(url), http)
 
     return exe
 
-def getshows():
-    print "Fetching shows"
-    req = urllib2.urlopen(SHOW_INDEX)
-    data = req.read()
-    if req.getcode() != 200:
-        print "Got code %d instead of 200.  Error page:" % req.getcode()
-        print data
-        return {}
+def fetch_page(url, parse):
+    # Returns (parse(data), unchanged).  With sync state the request is
+    # conditional, and on a 304 the stored result of the last parse is
+    # returned instead.
+    req = urllib2.Request(url)
+    cached = STATE.page(url) if STATE is not None else None
+    if cached is not None:
+        etag, last_modified, result = cached
+        if etag:
+            req.add_header("If-None-Match", etag)
+        if last_modified:
+            req.add_header("If-Modified-Since", last_modified)
+    try:
+        response = urllib2.urlopen(req, timeout=FETCH_TIMEOUT)
+        data = response.read()
+    except urllib2.HTTPError as err:
+        if err.code == 304 and cached is not None:
+            return result, True
+        raise
+    if response.getcode() != 200:
+        say("Got code %d instead of 200.  Error page:\n%s"
+            % (response.getcode(), data))
+        return None, False
+    result = parse(data)
+    headers = response.info()
+    if STATE is not None and (headers.get("ETag") or headers.get("Last-Modified")):
+        STATE.save_page(url, headers.get("ETag"), headers.get("Last-Modified"),
+                        result)
+    return result, False
+
+def parse_shows(data):
     soup = BeautifulSoup.BeautifulSoup(data)
     shows = {}
     for a in soup.findAll("a", "playLetterLink"):
         [empty, title] = a["href"].split("/")
         shows[title] = a.string
-    print "Found", len(shows), "shows"
     if len(shows) == 0:
-        print "Got %d bytes from %s (around 50-80 kB is normal)" % (
-            len(data), SHOW_INDEX)
+        say("Got %d bytes from %s (around 50-80 kB is normal)" % (
+            len(data), SHOW_INDEX))
+    return shows
+
+def getshows():
+    print "Fetching shows"
+    try:
+        shows, unchanged = fetch_page(SHOW_INDEX, parse_shows)
+    except (urllib2.URLError, socket.error) as err:
+        print "FAILED to fetch %s: %s" % (SHOW_INDEX, err)
+        return {}
+    if shows is None:
+        return {}
+    print "Found", len(shows), "shows"
     return shows
 
 def getshow_urls(readable_title, title):
-    print "Fetching %s (%s)" % (readable_title, title)
+    say("Fetching %s (%s)" % (readable_title, title))
     urls = []
     url = "http://www.svtplay.se/" + title
     while True:
-        print "Fetching", url
+        say("Fetching %s" % url)
         try:
-            data = urllib2.urlopen(url).read()
-        except urllib2.HTTPError:
-            print "FAILED to fetch", url
+            page, unchanged = fetch_page(url, parse_pager)
+        except (urllib2.URLError, socket.error):
+            say("FAILED to fetch %s" % url)
             break
-        soup = BeautifulSoup.BeautifulSoup(data)
-        pager_section = soup.find("div", "playPagerSections")
-        if pager_section is None:
+        if page is None:
             break
-        for a in pager_section.findAll("a", "playLink"):
-            lnk = a["href"]
-            # print a.find("h5").string.strip(), lnk
+        for lnk in page["links"]:
             urls = [lnk] + urls
-        pager = soup.find("ul", "playLargePager")
-        next_page = pager.find("a", "playPagerNext")
-        if next_page is None or "disabled" in next_page["class"]:
+        # An unchanged page with nothing new on it means the pages after
+        # it have nothing new either.
+        if unchanged and all(STATE.state(lnk) for lnk in page["links"]):
+            if page["next"] is not None:
+                say("Unchanged since last sync: %s" % url)
+                urls = [lnk for lnk in STATE.pending(title)
+                        if lnk not in urls] + urls
             break
-        url = "http://www.svtplay.se" + next_page["href"]
-    print "Found", len(urls), "episodes"
+        if page["next"] is None:
+            break
+        url = page["next"]
+    say("Found %d episodes in %s" % (len(urls), readable_title))
     return urls
 
-def run_download(data):
-    print "Download", data[0], "of", queuesize
-    data[1].execute()
+def parse_pager(data):
+    soup = BeautifulSoup.BeautifulSoup(data)
+    page = {"links": [], "next": None}
+    pager_section = soup.find("div", "playPagerSections")
+    if pager_section is None:
+        return page
+    for a in pager_section.findAll("a", "playLink"):
+        # print a.find("h5").string.strip(), a["href"]
+        page["links"].append(a["href"])
+    pager = soup.find("ul", "playLargePager")
+    if pager is None:
+        # A single page of episodes has no pager.
+        return page
+    next_page = pager.find("a", "playPagerNext")
+    if next_page is not None and "disabled" not in next_page["class"]:
+        page["next"] = "http://www.svtplay.se" + next_page["href"]
+    return page
+
+def crawl(titles, shows):
+    # Episode URLs of all shows, crawled concurrently.  The pages of a
+    # single show still have to be followed one after the other.
+    crawled = pirateplay.imap_unordered(
+        lambda series: (series, getshow_urls(shows[series], series)),
+        titles, CRAWL_WORKERS)
+    for series, urls in crawled:
+        if STATE is not None:
+            STATE.seen(series, urls)
+        for url in urls:
+            yield series, url
 
-def main():
-    global queuesize
+def resolve_episodes(episodes, ignore_downloaded, execute):
+    # cmdline() for each (series, url), on a bounded pool of workers, in
+    # completion order.  Episodes are taken from the crawl as it goes.
+    return pirateplay.imap_unordered(
+        lambda episode: cmdline(episode[0], episode[1],
+                                ignore_downloaded, execute),
+        episodes, RESOLVE_WORKERS)
 
+def main():
     args = sys.argv[1:]
     if len(args) == 0:
         print "Usage: series-fetcher { --print-shows | --download | --dry-run }\n"
@@ -211,28 +365,31 @@ def main():
         return
     if args[0] == "--download":
         load_series()
+        open_state()
         shows = getshows()
-        queue = []
         notfound = []
         for series in TITLES:
             if series not in shows:
                 print "Could not find", series
                 notfound.append(series)
-                continue
-            for url in getshow_urls(shows[series], series):
-                downloader = cmdline(series, url, True, True)
-                if downloader:
-                    queue.append(downloader)
-        queuesize = len(queue)
-        if queuesize > 0:
-            if PARALLELISM > 1:
-                pool = multiprocessing.Pool(min(PARALLELISM, queuesize))
-                pool.map(run_download, list(enumerate(queue)), 1)
-                pool.close()
-                pool.join()
-            else:
-                for data in enumerate(queue):
-                    run_download(data)
+        titles = [series for series in TITLES if series in shows]
+        episodes = ((series, url) for series, url in crawl(titles, shows)
+                    if STATE.state(url) != svtsync.DOWNLOADED)
+
+        # Downloads start as soon as the first episode is resolved, while
+        # the rest are still being crawled and resolved.
+        downloads = scheduler.DownloadScheduler(PARALLELISM, PER_HOST,
+                                                HOST_LIMITS, BANDWIDTH,
+                                                RETRIES)
+        for downloader in resolve_episodes(episodes, True, True):
+            if downloader:
+                downloads.add(downloader)
+        downloads.close()
+        print "Downloaded %d episodes" % downloads.completed
+        if downloads.failed:
+            print "FAILED to download:"
+            for downloader in downloads.failed:
+                print "  " + downloader.label
         if len(notfound) > 0:
             print
             print "WARNING: The following series in ~/.svtfetch was not found on"
@@ -246,12 +403,12 @@ def main():
         return
     if args[0] == "--dry-run":
         load_series()
+        open_state()
         shows = getshows()
-        for series in TITLES:
-            if series not in shows:
-                continue
-            for url in getshow_urls(shows[series], series):
-                print cmdline(series, url, False, False).encode('utf-8')
+        titles = [series for series in TITLES if series in shows]
+        for exe in resolve_episodes(crawl(titles, shows), False, False):
+            if exe:
+                say(exe.encode('utf-8'))
         return
     if args[0] == "--manual":
         load_series()
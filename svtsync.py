@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Persistent sync state for svtfetcher, kept in an SQLite database
+# (~/.svtfetch.db by default).
+#
+# pages     the parsed result of every index and pager page together
+#           with its ETag and Last-Modified, so the next run can make
+#           conditional requests and reuse the result on a 304.
+# episodes  every episode URL seen, and whether it has been resolved
+#           (with the command) and downloaded.
+
+import json
+import sqlite3
+import threading
+import time
+
+SEEN, RESOLVED, DOWNLOADED = "seen", "resolved", "downloaded"
+
+SCHEMA = """
+create table if not exists pages (
+    url text primary key,
+    etag text,
+    last_modified text,
+    data text,
+    fetched real
+);
+create table if not exists episodes (
+    url text primary key,
+    series text,
+    state text,
+    cmd text,
+    first_seen real,
+    updated real
+);
+"""
+
+class SyncState(object):
+    def __init__(self, path):
+        # Shared by the crawl, resolve and download threads.
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__db.executescript(SCHEMA)
+
+    def page(self, url):
+        # (etag, last_modified, data) for url, or None.
+        with self.__lock:
+            row = self.__db.execute(
+                "select etag, last_modified, data from pages where url = ?",
+                (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def save_page(self, url, etag, last_modified, data):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "insert or replace into pages values (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, json.dumps(data), time.time()))
+
+    def state(self, url):
+        with self.__lock:
+            row = self.__db.execute(
+                "select state from episodes where url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def seen(self, series, urls):
+        # Records urls as seen and returns those that were new.
+        now = time.time()
+        new = []
+        with self.__lock, self.__db:
+            for url in urls:
+                cursor = self.__db.execute(
+                    "insert or ignore into episodes values (?, ?, ?, null, ?, ?)",
+                    (url, series, SEEN, now, now))
+                if cursor.rowcount:
+                    new.append(url)
+        return new
+
+    def pending(self, series):
+        # Episodes of series seen earlier but not yet downloaded.
+        with self.__lock:
+            rows = self.__db.execute(
+                "select url from episodes where series = ? and state != ? "
+                "order by first_seen", (series, DOWNLOADED)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark(self, url, state, cmd=None):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "update episodes set state = ?, cmd = coalesce(?, cmd), "
+                "updated = ? where url = ?", (state, cmd, time.time(), url))
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
@@ -0,0 +1,81 @@
+import BaseHTTPServer, SocketServer, threading
+
+import pirateplay
+from benchmark import StubServer
+from connpool import pool
+
+# An upstream for the resolver made of canned responses, keyed like the
+# benchmark fixtures ('GET http://host/path').  Every connection the pool
+# makes goes to it while it is installed.
+
+svtplay_url = 'http://www.svtplay.se/video/1'
+svtplay_json = ('{"video":{"videoReferences":[{"url":"rtmp://a/b","bitrate":800},'
+	'{"url":"http://x/y.mp4","bitrate":1200}],"subtitleReferences":[{"url":"http://sub"}]}}')
+svtplay_responses = {'GET http://svtplay.se/video/1?type=embed&output=json': {'body': svtplay_json}}
+
+class Upstream(object):
+	def __init__(self, responses):
+		self.server = StubServer(responses)
+		self._thread = threading.Thread(target = self.server.serve_forever)
+		self._thread.daemon = True
+	def __enter__(self):
+		self._thread.start()
+		pool.close()
+		pool.connect_to = lambda scheme, host: self.server.server_address
+		self._cache, self._health = pirateplay.response_cache, pirateplay.health
+		pirateplay.set_cache(None)
+		pirateplay.set_health(None)
+		return self
+	def __exit__(self, *exc_info):
+		pool.close()
+		pool.connect_to = None
+		pirateplay.set_cache(self._cache)
+		pirateplay.set_health(self._health)
+		self.server.shutdown()
+		self.server.server_close()
+
+# A file server honouring single Range requests, which can be told to
+# ignore them or to cut the next few ranged responses short.
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		server = self.server
+		data = server.data
+		with server.lock:
+			server.requests.append(self.headers.get('Range'))
+		byte_range = self.headers.get('Range')
+		if byte_range is None or not server.ranges:
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+			return
+		start, end = [int(n) for n in byte_range[len('bytes='):].split('-')]
+		body = data[start:end + 1]
+		if not body:
+			self.send_response(416)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		self.send_response(206)
+		self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, start + len(body) - 1, len(data)))
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('ETag', '"v1"')
+		self.end_headers()
+		with server.lock:
+			drop = server.drops > 0 and len(body) > 1
+			if drop:
+				server.drops -= 1
+		self.wfile.write(body[:len(body) // 2] if drop else body)
+	def log_message(self, format, *args):
+		pass
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	def __init__(self, data):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RangeHandler)
+		self.data = data
+		self.ranges = True
+		self.drops = 0
+		self.requests = []
+		self.lock = threading.Lock()
@@ -0,0 +1,164 @@
+import os, shutil, tempfile, threading, unittest
+
+import catalogue
+from tests.stub import RangeServer
+
+def programmes(changed = None):
+	data = {}
+	for channel in ('svt', 'tv4'):
+		data[channel] = {}
+		for n in range(40):
+			title = 'programme %d' % n
+			data[channel][title] = dict(('episode %d' % e, '/%s/%d/%d' % (channel, n, e)) for e in range(20))
+	if changed is not None:
+		data['svt']['programme 7'] = {'new episode': changed}
+	return data
+
+class CatalogueCase(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.catalogues = []
+
+	def tearDown(self):
+		for opened in self.catalogues:
+			opened.close()
+		shutil.rmtree(self.dir)
+
+	def build(self, data, name = 'built'):
+		path = os.path.join(self.dir, name)
+		catalogue.write(path, data)
+		with open(path, 'rb') as f:
+			return f.read()
+
+	def open(self, path):
+		opened = catalogue.Catalogue(path)
+		self.catalogues.append(opened)
+		return opened
+
+class CatalogueTest(CatalogueCase):
+	def test_round_trip(self):
+		data = programmes()
+		catalogue.write(os.path.join(self.dir, 'c'), data)
+		opened = self.open(os.path.join(self.dir, 'c'))
+		self.assertEqual(opened.channels(), ['svt', 'tv4'])
+		self.assertEqual(len(opened.programmes('svt')), 40)
+		self.assertEqual(opened.episodes('tv4', 'programme 3'), data['tv4']['programme 3'])
+		self.assertTrue(opened.has('svt', 'programme 0'))
+		self.assertFalse(opened.has('svt', 'programme 99'))
+
+	def test_damaged(self):
+		path = os.path.join(self.dir, 'c')
+		with open(path, 'wb') as f:
+			f.write('not a catalogue\n')
+		self.assertRaises(catalogue.CatalogueError, catalogue.Catalogue, path)
+
+class UpdateTest(CatalogueCase):
+	def setUp(self):
+		CatalogueCase.setUp(self)
+		self.server = RangeServer(self.build(programmes()))
+		thread = threading.Thread(target = self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.url = 'http://127.0.0.1:%d/catalogue.dat' % self.server.server_address[1]
+		self.path = os.path.join(self.dir, 'local')
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		CatalogueCase.tearDown(self)
+
+	def update(self):
+		del self.server.requests[:]
+		updated = catalogue.update(self.url, self.path)
+		self.catalogues.append(updated)
+		return updated
+
+	def local(self):
+		with open(self.path, 'rb') as f:
+			return f.read()
+
+	def requested(self):
+		# Bytes asked for with Range requests.
+		total = 0
+		for byte_range in self.server.requests:
+			start, end = [int(n) for n in byte_range[len('bytes='):].split('-')]
+			total += end - start + 1
+		return total
+
+	def test_first_update(self):
+		self.update()
+		self.assertEqual(self.local(), self.server.data)
+
+	def test_unchanged(self):
+		self.update()
+		self.update()
+		start, base = catalogue.parse_header(self.server.data[:catalogue.head_size])
+		self.assertEqual(self.requested(), base)
+
+	def test_fetches_only_changed_records(self):
+		self.update()
+		self.server.data = self.build(programmes(changed = '/svt/new'))
+		updated = self.update()
+		self.assertEqual(self.local(), self.server.data)
+		self.assertEqual(updated.episodes('svt', 'programme 7'), {'new episode': '/svt/new'})
+		self.assertTrue(self.requested() < len(self.server.data) // 4)
+
+	def test_server_without_ranges(self):
+		self.server.ranges = False
+		self.update()
+		self.assertEqual(self.local(), self.server.data)
+
+	def test_short_index_refetches_everything(self):
+		self.update()
+		self.server.data = self.build(programmes(changed = '/svt/new'))
+		start, base = catalogue.parse_header(self.server.data[:catalogue.head_size])
+		self.assertTrue(base > catalogue.head_size)
+		original = catalogue.fetch_range
+		def fetch_range(url, start, end):
+			if 0 < start < base:
+				self.server.drops = 1
+			return original(url, start, end)
+		catalogue.fetch_range = fetch_range
+		try:
+			self.update()
+		finally:
+			catalogue.fetch_range = original
+		self.assertEqual(self.local(), self.server.data)
+		self.assertEqual(self.server.requests[-1], None)
+
+	def test_short_record_refetches_everything(self):
+		self.update()
+		self.server.data = self.build(programmes(changed = '/svt/new'))
+		start, base = catalogue.parse_header(self.server.data[:catalogue.head_size])
+		original = catalogue.fetch_range
+		def fetch_range(url, start, end):
+			if start >= base:
+				self.server.drops = 1
+			return original(url, start, end)
+		catalogue.fetch_range = fetch_range
+		try:
+			self.update()
+		finally:
+			catalogue.fetch_range = original
+		self.assertEqual(self.local(), self.server.data)
+		self.assertEqual(self.server.requests[-1], None)
+
+	def test_wrong_record_refetches_everything(self):
+		self.update()
+		changed = self.build(programmes(changed = '/svt/new'))
+		# Same length as the real record, different bytes.
+		self.server.data = changed.replace('/svt/new', '/svt/bad')
+		original = catalogue.fetch_full
+		def fetch_full(url, path):
+			self.server.data = changed
+			original(url, path)
+		catalogue.fetch_full = fetch_full
+		try:
+			updated = self.update()
+		finally:
+			catalogue.fetch_full = original
+		self.assertEqual(self.local(), changed)
+		self.assertEqual(updated.episodes('svt', 'programme 7'), {'new episode': '/svt/new'})
+
+if __name__ == '__main__':
+	unittest.main()
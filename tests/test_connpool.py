@@ -0,0 +1,70 @@
+import socket, threading, time, unittest
+
+from benchmark import StubServer
+from connpool import ConnectionPool
+
+responses = {'GET http://example.com/small': {'body': 'small'},
+	'GET http://example.com/large': {'body': 'large', 'tail': 1 << 20}}
+
+class ConnectionPoolTest(unittest.TestCase):
+	def setUp(self):
+		self.stub = StubServer(responses)
+		thread = threading.Thread(target = self.stub.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.pool = ConnectionPool(max_idle = 2)
+		self.pool.connect_to = lambda scheme, host: self.stub.server_address
+
+	def tearDown(self):
+		self.pool.close()
+		self.stub.shutdown()
+		self.stub.server_close()
+
+	def get(self, path):
+		return self.pool.request('GET', 'example.com', path, headers = {'Host': 'example.com'})
+
+	def test_reuses_connections_read_to_the_end(self):
+		for i in range(3):
+			response = self.get('/small')
+			self.assertEqual(response.read(), 'small')
+		stats = self.pool.stats()
+		self.assertEqual((stats['created'], stats['reused'], stats['requests']), (1, 2, 3))
+		self.assertEqual(stats['idle'], 1)
+
+	def test_close_drains_a_short_body(self):
+		self.get('/small').close()
+		self.assertEqual(self.pool.stats()['idle'], 1)
+
+	def test_abort_drops_the_connection(self):
+		response = self.get('/large')
+		self.assertEqual(response.read(5), 'large')
+		response.abort()
+		self.assertEqual(self.pool.stats()['idle'], 0)
+		self.assertEqual(self.get('/small').read(), 'small')
+		self.assertEqual(self.pool.stats()['created'], 2)
+
+	def test_retries_a_dropped_idle_connection(self):
+		self.get('/small').read()
+		# As if the server had hung up on the idle connection.
+		for conns in self.pool._idle.values():
+			for conn in conns:
+				conn.sock.shutdown(socket.SHUT_RDWR)
+		self.assertEqual(self.get('/small').read(), 'small')
+		self.assertEqual(self.pool.stats()['created'], 2)
+
+	def test_expires_old_connections(self):
+		self.pool.max_age = 0.05
+		self.get('/small').read()
+		time.sleep(0.1)
+		self.get('/small').read()
+		stats = self.pool.stats()
+		self.assertEqual((stats['created'], stats['reused']), (2, 0))
+
+	def test_keeps_at_most_max_idle(self):
+		responses = [self.get('/small') for i in range(3)]
+		for response in responses:
+			response.read()
+		self.assertEqual(self.pool.stats()['idle'], 2)
+
+if __name__ == '__main__':
+	unittest.main()
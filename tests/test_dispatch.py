@@ -0,0 +1,67 @@
+import re, time, unittest
+
+import dispatch
+
+class Slow(object):
+	# Matches that each take delay seconds to find.
+	def __init__(self, count, delay):
+		self.matches = iter([re.match('(?P<n>.)', str(n)) for n in range(count)])
+		self.delay = delay
+	def __iter__(self):
+		return self
+	def next(self):
+		time.sleep(self.delay)
+		return next(self.matches)
+
+class BudgetTest(unittest.TestCase):
+	def test_within_budget(self):
+		found = list(dispatch.budgeted(Slow(3, 0), 1))
+		self.assertEqual(found, [{'n': '0'}, {'n': '1'}, {'n': '2'}])
+
+	def test_gives_up_between_matches(self):
+		found = []
+		def run():
+			for groups in dispatch.budgeted(Slow(100, 0.02), 0.1):
+				found.append(groups)
+		self.assertRaises(dispatch.BudgetExceeded, run)
+		self.assertTrue(3 <= len(found) < 10)
+
+class Body(object):
+	def __init__(self, data):
+		self.data = data
+		self.read_bytes = 0
+		self.aborted = self.closed = False
+	def read(self, size):
+		chunk = self.data[self.read_bytes:self.read_bytes + size]
+		self.read_bytes += len(chunk)
+		return chunk
+	def abort(self):
+		self.aborted = True
+	def close(self):
+		self.closed = True
+
+class StreamMatchesTest(unittest.TestCase):
+	page = 'x' * 1000 + 'id="1" id="2"' + 'y' * 100000 + 'id="3"'
+
+	def matches(self, body, stream):
+		step = {'stream': stream}
+		return [groups['id'] for groups in dispatch.stream_matches(re.compile('id="(?P<id>\\d)"'), body, step)]
+
+	def test_hangs_up_after_enough_matches(self):
+		body = Body(self.page)
+		self.assertEqual(self.matches(body, 1), ['1'])
+		self.assertTrue(body.aborted and body.closed)
+		self.assertTrue(body.read_bytes < len(self.page))
+
+	def test_reads_to_the_end_for_every_match(self):
+		body = Body(self.page)
+		self.assertEqual(self.matches(body, True), ['1', '2', '3'])
+		self.assertFalse(body.aborted)
+		self.assertEqual(body.read_bytes, len(self.page))
+
+	def test_matches_across_chunks(self):
+		page = 'x' * (dispatch.chunk_size - 3) + 'id="7"' + 'y' * 10
+		self.assertEqual(self.matches(Body(page), 1), ['7'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,84 @@
+import time, unittest
+
+import pirateplay
+from health import HealthTracker
+from tests.stub import Upstream, svtplay_responses, svtplay_url
+
+class HealthTrackerTest(unittest.TestCase):
+	def test_opens_after_threshold_failures(self):
+		health = HealthTracker(threshold = 2)
+		health.failure('a', 'timeout')
+		self.assertTrue(health.allow('a', 'u'))
+		health.failure('a', 'timeout')
+		self.assertFalse(health.allow('a', 'u'))
+		self.assertFalse(health.allow('a', 'v'))
+		self.assertTrue(health.allow('b', 'u'))
+		self.assertEqual(health.stats()['chains']['a']['state'], 'open')
+		self.assertEqual(health.skipped, 2)
+
+	def test_half_open_trial(self):
+		health = HealthTracker(threshold = 1, cooldown = 0.05)
+		health.failure('a', 'timeout')
+		time.sleep(0.06)
+		self.assertTrue(health.allow('a', 'u'))
+		# One trial at a time.
+		self.assertFalse(health.allow('a', 'u'))
+		health.failure('a', 'timeout')
+		stats = health.stats()['chains']['a']
+		self.assertEqual((stats['state'], stats['trips']), ('open', 2))
+		# The cooldown doubles.
+		self.assertTrue(stats['retry_in'] > 0.05)
+		time.sleep(0.11)
+		self.assertTrue(health.allow('a', 'u'))
+		health.success('a', 'u')
+		self.assertEqual(health.stats()['chains'], {})
+
+	def test_empty_is_per_url(self):
+		health = HealthTracker(empty_ttl = 0.05, size = 2)
+		health.empty('a', 'u')
+		self.assertFalse(health.allow('a', 'u'))
+		self.assertTrue(health.allow('a', 'v'))
+		time.sleep(0.06)
+		self.assertTrue(health.allow('a', 'u'))
+		for url in ('v', 'w', 'x'):
+			health.empty('a', url)
+		self.assertEqual(health.stats()['negative'], 2)
+
+class ResolverHealthTest(unittest.TestCase):
+	responses = dict(svtplay_responses)
+	responses['GET http://svtplay.se/video/2?type=embed&output=json'] = {'status': 503, 'body': ''}
+
+	def setUp(self):
+		self.upstream = Upstream(self.responses).__enter__()
+		self.health = HealthTracker()
+		pirateplay.set_health(self.health)
+		self.backoff, pirateplay.retry_backoff = pirateplay.retry_backoff, 0
+
+	def tearDown(self):
+		pirateplay.retry_backoff = self.backoff
+		self.upstream.__exit__(None, None, None)
+
+	def resolve(self, url):
+		return list(pirateplay.generate_getcmd(url, output_file = '-'))
+
+	def test_off_by_default(self):
+		self.assertEqual(self.upstream._health, None)
+
+	def test_not_found_only_skips_that_url(self):
+		for i in range(5):
+			self.resolve('http://www.svtplay.se/video/gone%d' % i)
+		stats = self.health.stats()
+		self.assertEqual(stats['chains'], {})
+		self.assertEqual(stats['negative'], 10)
+		self.assertEqual(len(self.resolve(svtplay_url)), 1)
+
+	def test_server_errors_open_the_breaker(self):
+		for i in range(3):
+			self.resolve('http://www.svtplay.se/video/2')
+		chains = self.health.stats()['chains']
+		self.assertEqual(sorted(chains), ['SVT-play-beta', 'SVT-play-http'])
+		self.assertEqual(chains['SVT-play-beta']['state'], 'open')
+		self.assertEqual(self.resolve(svtplay_url), [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,81 @@
+import os, random, shutil, tempfile, threading, unittest
+
+import httpget
+from tests.stub import RangeServer
+
+class DownloadTest(unittest.TestCase):
+	data = ''.join(chr(random.randrange(256)) for i in range(3 * httpget.min_segment + 123))
+
+	def setUp(self):
+		self.server = RangeServer(self.data)
+		thread = threading.Thread(target = self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.url = 'http://127.0.0.1:%d/video.mp4' % self.server.server_address[1]
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'video.mp4')
+		self.saved = httpget.retries, httpget.time.sleep
+		httpget.time.sleep = lambda seconds: None
+
+	def tearDown(self):
+		httpget.retries, httpget.time.sleep = self.saved
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.dir)
+
+	def downloaded(self):
+		with open(self.path, 'rb') as f:
+			return f.read() == self.data
+
+	def test_segmented(self):
+		httpget.download(self.url, self.path)
+		self.assertTrue(self.downloaded())
+		self.assertEqual(os.listdir(self.dir), ['video.mp4'])
+
+	def test_retries_short_segments(self):
+		self.server.drops = 2
+		httpget.download(self.url, self.path)
+		self.assertTrue(self.downloaded())
+
+	def test_without_ranges(self):
+		self.server.ranges = False
+		httpget.download(self.url, self.path)
+		self.assertTrue(self.downloaded())
+
+	def test_resumes_from_parts(self):
+		httpget.retries = 0
+		self.server.drops = 100
+		self.assertRaises(httpget.DownloadError, httpget.download, self.url, self.path)
+		self.assertTrue(os.path.exists(self.path + '.tmp.parts'))
+		self.server.drops = 0
+		progress = []
+		httpget.download(self.url, self.path, progress = lambda done, total: progress.append(done))
+		self.assertTrue(self.downloaded())
+		self.assertTrue(progress[0] > len(self.data) // 2)
+
+	def test_parts_only_claim_bytes_on_disk(self):
+		checked = []
+		save_parts = httpget.Download.save_parts
+		def checking(download):
+			with open(download.tmppath, 'rb') as f:
+				for start, end, done in download.segments:
+					f.seek(start)
+					checked.append(f.read(done) == self.data[start:start + done])
+			save_parts(download)
+		httpget.Download.save_parts = checking
+		saved, httpget.save_interval = httpget.save_interval, 0
+		try:
+			httpget.download(self.url, self.path)
+		finally:
+			httpget.Download.save_parts = save_parts
+			httpget.save_interval = saved
+		self.assertTrue(len(checked) > 10)
+		self.assertTrue(all(checked))
+
+	def test_progressive(self):
+		self.assertTrue(httpget.progressive('http://x/a.mp4'))
+		self.assertFalse(httpget.progressive('http://x/a.m3u8?x=1'))
+		self.assertFalse(httpget.progressive('rtmp://x/a.mp4'))
+
+if __name__ == '__main__':
+	unittest.main()
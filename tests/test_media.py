@@ -0,0 +1,49 @@
+import unittest
+
+from media import Job, RingBuffer
+
+class RingBufferTest(unittest.TestCase):
+	def test_write_stops_when_full(self):
+		ring = RingBuffer(8)
+		self.assertEqual(ring.write('abcdef'), 6)
+		self.assertEqual(ring.write('ghijk'), 2)
+		self.assertEqual(ring.free(), 0)
+		self.assertEqual(ring.peek(100), 'abcdefgh')
+
+	def test_wraps_around(self):
+		ring = RingBuffer(8)
+		ring.write('abcdef')
+		ring.consume(4)
+		self.assertEqual(ring.write('ghijkl'), 6)
+		self.assertEqual(ring.size, 8)
+		# peek() stops at the end of the underlying buffer.
+		self.assertEqual(ring.peek(100), 'efgh')
+		ring.consume(4)
+		self.assertEqual(ring.peek(100), 'ijkl')
+		ring.consume(4)
+		self.assertEqual((ring.size, ring.free()), (0, 8))
+
+	def test_keeps_order_through_many_passes(self):
+		ring = RingBuffer(7)
+		data = ''.join(chr(ord('a') + n % 26) for n in range(1000))
+		written = read = 0
+		out = []
+		while read < len(data):
+			written += ring.write(data[written:written + 5])
+			chunk = ring.peek(3)
+			ring.consume(len(chunk))
+			read += len(chunk)
+			out.append(chunk)
+		self.assertEqual(''.join(out), data)
+
+class JobTest(unittest.TestCase):
+	def test_parses_rtmpdump_progress(self):
+		job = Job('download', 'x')
+		job.parse('1234.567 kB / 12.34 sec')
+		self.assertEqual((job.kbytes, job.percent), (1234.567, None))
+		self.assertEqual(job.status(), 'download x: 1234 kB')
+		job.parse('2048.000 kB / 20.00 sec (41.5%)')
+		self.assertEqual(job.status(), 'download x: 41.5%')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,68 @@
+import socket, threading, time, unittest, urllib2
+
+import pirateplay
+from connpool import pool
+
+class ImapUnorderedTest(unittest.TestCase):
+	def test_yields_every_result(self):
+		self.assertEqual(sorted(pirateplay.imap_unordered(lambda n: n * 2, range(20), 4)), range(0, 40, 2))
+
+	def test_worker_errors_reach_the_consumer(self):
+		def func(n):
+			if n == 3:
+				raise KeyError(n)
+			return n
+		results = []
+		def consume():
+			try:
+				for result in pirateplay.imap_unordered(func, range(10), 3):
+					results.append(result)
+			except KeyError as err:
+				results.append(err)
+		thread = threading.Thread(target = consume)
+		thread.daemon = True
+		thread.start()
+		thread.join(5)
+		self.assertFalse(thread.is_alive())
+		self.assertTrue(isinstance(results[-1], KeyError))
+
+class SilentUpstreamTest(unittest.TestCase):
+	# An upstream that accepts connections and never answers.
+	def setUp(self):
+		self.listener = socket.socket()
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(16)
+		self.saved = pirateplay.opener, pirateplay.fetch_timeout, pirateplay.retry_backoff, pirateplay.health
+		pirateplay.fetch_timeout = (0.2, 0.2)
+		pirateplay.retry_backoff = 0
+		pirateplay.set_health(None)
+		pool.close()
+		pool.connect_to = lambda scheme, host: self.listener.getsockname()
+
+	def tearDown(self):
+		pirateplay.opener, pirateplay.fetch_timeout, pirateplay.retry_backoff, pirateplay.health = self.saved
+		pool.close()
+		pool.connect_to = None
+		self.listener.close()
+
+	def test_bare_socket_errors_fail_the_chain(self):
+		# As from an opener that lets a timeout in getresponse() through
+		# without wrapping it in a URLError.
+		class Opener(object):
+			def open(self, req, data, timeout):
+				return pool.request('GET', req.get_host(), req.get_selector(), timeout = timeout)
+		pirateplay.opener = Opener()
+		state = {}
+		url = 'http://svtplay.se/video/1'
+		self.assertEqual(pirateplay.fetch({}, url, {}, state = state), None)
+		self.assertEqual(state['failed'], 1)
+		self.assertTrue('timeout' in state['broken'])
+
+	def test_resolve_gives_up(self):
+		started = time.time()
+		self.assertEqual(list(pirateplay.generate_getcmd('http://www.svtplay.se/video/1', output_file = '-')),
+			['http://svtplay.se/video/1?type=embed&output=json'] * 2)
+		self.assertTrue(time.time() - started < 5)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,158 @@
+import httplib, json, threading, unittest, urllib
+
+import server
+from tests.stub import Upstream, svtplay_responses, svtplay_url
+
+class ServerCase(unittest.TestCase):
+	def tearDown(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+		self.upstream.__exit__(None, None, None)
+
+	def start(self, httpd):
+		self.httpd = httpd
+		thread = threading.Thread(target = httpd.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def request(self, method, path, body = None):
+		conn = httplib.HTTPConnection(*self.httpd.server_address)
+		try:
+			conn.request(method, path, body)
+			response = conn.getresponse()
+			return response.status, json.loads(response.read())
+		finally:
+			conn.close()
+
+class ServerTest(ServerCase):
+	def setUp(self):
+		self.upstream = Upstream(svtplay_responses).__enter__()
+		self.start(server.ResolveServer(('127.0.0.1', 0), 4))
+
+	def test_get_resolve(self):
+		status, record = self.request('GET', '/resolve?' + urllib.urlencode({'url': svtplay_url}))
+		self.assertEqual(status, 200)
+		self.assertEqual(record['url'], svtplay_url)
+		self.assertEqual(record['service'], 'SVT-play-beta')
+		self.assertEqual(record['error'], None)
+		self.assertEqual(record['bitrates'], [800])
+
+	def test_get_resolve_all(self):
+		status, record = self.request('GET', '/resolve?' + urllib.urlencode({'url': svtplay_url, 'all': 1}))
+		self.assertEqual(record['bitrates'], [800, 1200])
+
+	def test_get_without_url(self):
+		self.assertEqual(self.request('GET', '/resolve')[0], 400)
+
+	def test_unknown_path(self):
+		self.assertEqual(self.request('GET', '/nothing')[0], 404)
+		self.assertEqual(self.request('POST', '/nothing', '[]')[0], 404)
+
+	def test_post_resolve_keeps_order(self):
+		urls = [svtplay_url, 'http://nowhere.example/', svtplay_url + '?again']
+		status, records = self.request('POST', '/resolve?all=1', json.dumps(urls))
+		self.assertEqual(status, 200)
+		self.assertEqual([record['url'] for record in records], urls)
+		self.assertEqual(records[0]['bitrates'], [800, 1200])
+		self.assertEqual(records[1]['streams'], [])
+
+	def test_post_rejects_bad_body(self):
+		self.assertEqual(self.request('POST', '/resolve', '{"url": 1}')[0], 400)
+		self.assertEqual(self.request('POST', '/resolve', 'not json')[0], 400)
+
+	def test_select(self):
+		query = urllib.urlencode({'url': svtplay_url, 'all': 1, 'select': 'highest'})
+		status, record = self.request('GET', '/resolve?' + query)
+		self.assertEqual(status, 200)
+		self.assertEqual(record['bitrates'], [1200])
+		status, records = self.request('POST', '/resolve?all=1&select=http', json.dumps([svtplay_url]))
+		self.assertEqual([stream['protocol'] for stream in records[0]['streams']], ['http'])
+
+	def test_bad_options(self):
+		for query in ('select=nonsense', 'deadline=soon', 'deadline=0'):
+			self.assertEqual(self.request('GET', '/resolve?url=x&' + query)[0], 400)
+			self.assertEqual(self.request('POST', '/resolve?' + query, '[]')[0], 400)
+
+	def test_stats(self):
+		self.request('GET', '/resolve?' + urllib.urlencode({'url': svtplay_url}))
+		status, stats = self.request('GET', '/stats')
+		self.assertEqual(status, 200)
+		self.assertEqual(stats['requests'], 1)
+		self.assertEqual(stats['coalesced'], 0)
+		self.assertTrue(stats['pool']['requests'] >= 1)
+
+class OptionsTest(ServerCase):
+	def setUp(self):
+		self.upstream = Upstream({}).__enter__()
+		self.start(server.ResolveServer(('127.0.0.1', 0), 4, self.resolver, select = 'first', deadline = 5))
+		self.calls = []
+
+	def resolver(self, url, fanout, policy, deadline, **args):
+		self.calls.append((url, fanout, policy, deadline))
+		return {'url': url, 'streams': [], 'error': None, 'elapsed': 0}
+
+	def test_options_reach_the_resolver(self):
+		calls = self.calls
+		self.request('GET', '/resolve?url=a')
+		self.request('GET', '/resolve?url=b&deadline=1.5&select=')
+		self.assertEqual(calls[0][3], 5)
+		self.assertEqual(type(calls[0][2]).__name__, 'FirstHit')
+		self.assertEqual(calls[1][2:], (None, 1.5))
+
+class CoalescerTest(unittest.TestCase):
+	def test_concurrent_calls_share_one_evaluation(self):
+		release = threading.Event()
+		calls = []
+		def slow(url):
+			calls.append(url)
+			release.wait(5)
+			return url.upper()
+		coalescer = server.Coalescer(slow)
+		results = []
+		threads = [threading.Thread(target = lambda: results.append(coalescer('a'))) for i in range(3)]
+		for thread in threads:
+			thread.start()
+		while coalescer.calls < 3:
+			threading.Event().wait(0.01)
+		release.set()
+		for thread in threads:
+			thread.join(5)
+		self.assertEqual(calls, ['a'])
+		self.assertEqual(results, ['A'] * 3)
+		self.assertEqual(coalescer.coalesced, 2)
+		self.assertEqual(coalescer('b'), 'B')
+		self.assertEqual(calls, ['a', 'b'])
+
+	def test_followers_retry_after_a_failure(self):
+		release = threading.Event()
+		calls = []
+		def flaky(url):
+			calls.append(url)
+			if len(calls) == 1:
+				release.wait(5)
+				raise ValueError(url)
+			return url
+		coalescer = server.Coalescer(flaky)
+		errors = []
+		def leader():
+			try:
+				coalescer('a')
+			except ValueError as err:
+				errors.append(err)
+		first = threading.Thread(target = leader)
+		first.start()
+		while coalescer.calls < 1:
+			threading.Event().wait(0.01)
+		results = []
+		second = threading.Thread(target = lambda: results.append(coalescer('a')))
+		second.start()
+		while coalescer.calls < 2:
+			threading.Event().wait(0.01)
+		release.set()
+		first.join(5)
+		second.join(5)
+		self.assertEqual(len(errors), 1)
+		self.assertEqual(results, ['a'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,55 @@
+import json, threading, time
+
+# Per-step spans emitted by pirateplay.run_steps when a tracer is
+# installed with pirateplay.set_tracer().  A tracer is any callable
+# taking a Span; JsonLinesExporter writes them to a trace file.
+
+class Span(object):
+	__slots__ = ('url', 'service', 'step', 'template', 'started', 'status', 'fetches', 'cached',
+		'bytes', 'fetch_time', 'regex_time', 'matches', 'error')
+
+	def __init__(self, url, service, step, template):
+		self.url = url
+		self.service = service
+		self.step = step
+		self.template = template
+		self.started = time.time()
+		self.status = None
+		self.fetches = 0
+		self.cached = 0
+		self.bytes = 0
+		self.fetch_time = 0.0
+		self.regex_time = 0.0
+		self.matches = 0
+		self.error = None
+
+	def timed(self, matches):
+		# Wraps a step's match iterator, charging the time spent looking for
+		# each match to regex_time.
+		while True:
+			started = time.time()
+			match = next(matches, None)
+			self.regex_time += time.time() - started
+			if match is None:
+				return
+			self.matches += 1
+			yield match
+
+	def to_dict(self):
+		return dict((name, getattr(self, name)) for name in self.__slots__)
+
+	def __repr__(self):
+		return '<Span %s step %d: %d matches, %d bytes, fetch %.3fs, regex %.3fs>' % (
+			self.service, self.step, self.matches, self.bytes, self.fetch_time, self.regex_time)
+
+class JsonLinesExporter(object):
+	def __init__(self, path):
+		self.file = open(path, 'a')
+		self._lock = threading.Lock()
+	def __call__(self, span):
+		line = json.dumps(span.to_dict()) + '\n'
+		with self._lock:
+			self.file.write(line)
+			self.file.flush()
+	def close(self):
+		self.file.close()